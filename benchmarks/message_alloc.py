@@ -0,0 +1,97 @@
+"""
+Micro benchmark of message allocation in one logic -> device -> logic round trip (without hardware)
+
+The round trip follows LogicDevice and Hid_Device: a ServerMessage command is sent to the device pipe,
+the device replies a HidMessage to the logic pipe, then the logic side consumes and releases them.
+Run with pool disabled (as before) and enabled:
+
+    python -m benchmarks.message_alloc [-n 20000]
+"""
+import argparse
+import array
+import sys
+import time
+
+from server.message import BaseMessage, Message, HidMessage, ServerMessage, MessageServer, Token
+
+class AllocCounter(object):
+    "count the message objects constructed, not only initialized again from the free list"
+    def __init__(self):
+        self.count = 0
+        self._init = BaseMessage.__init__
+
+    def __enter__(self):
+        init = self._init
+
+        def counting_init(obj, *args, **kwargs):
+            try:
+                obj._location
+            except AttributeError:  # slot never set, new object
+                self.count += 1
+            init(obj, *args, **kwargs)
+
+        BaseMessage.__init__ = counting_init
+        return self
+
+    def __exit__(self, *exc):
+        BaseMessage.__init__ = self._init
+
+def round_trip(logic_pipe, phy_pipe, n, payload):
+    for i in range(n):
+        # logic side: LogicDevice.prepare_command() / send_command()
+        cmd = ServerMessage.alloc(Message.CMD_DEVICE_BLOCK_READ, 'bench', Token([i]), addr=0x100, size=len(payload))
+        cmd.set_pipe(phy_pipe)
+        cmd.send()
+
+        # device side: Hid_Device.process() / handle_phy_message()
+        msg = phy_pipe.recv()
+        seq = msg.seq()
+        reply = HidMessage.alloc(msg.type(), msg.id(), seq, value=payload, pipe=logic_pipe)
+        reply.send()
+        reply.release()
+        msg.release()
+
+        # logic side: MainScreen.dispatch() / LogicDevice.handle_message()
+        msg = logic_pipe.recv()
+        if msg.seq() == cmd.seq():
+            msg.value()
+        msg.release()
+        cmd.release()
+
+def run(n, pool_size):
+    BaseMessage.POOL_SIZE = pool_size
+    for c in (BaseMessage, HidMessage, ServerMessage):
+        del c._pool[:]
+
+    logic_pipe = MessageServer.mPipe('bench:logic')
+    phy_pipe = MessageServer.mPipe('bench:phy')
+    payload = array.array('B', range(32))
+    round_trip(logic_pipe, phy_pipe, 100, payload)   # warm up the free list
+
+    with AllocCounter() as counter:
+        round_trip(logic_pipe, phy_pipe, n, payload)
+
+    t = time.perf_counter()
+    round_trip(logic_pipe, phy_pipe, n, payload)
+    elapsed = time.perf_counter() - t
+
+    return dict(pool_size=pool_size,
+                alloc_per_round_trip=counter.count / n,
+                us_per_round_trip=elapsed / n * 1e6)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20000, help='round trips')
+    args = parser.parse_args()
+
+    pool_size = BaseMessage.POOL_SIZE
+    sample = BaseMessage('Device', 0, 'bench', Token([]))
+    print("message object size: {} bytes (__slots__, no __dict__)".format(sys.getsizeof(sample)))
+    print("{:>10} {:>22} {:>18}".format('pool', 'messages/round trip', 'us/round trip'))
+    for size in (0, pool_size):
+        r = run(args.n, size)
+        print("{pool_size:>10} {alloc_per_round_trip:>22.2f} {us_per_round_trip:>18.2f}".format(**r))
+    BaseMessage.POOL_SIZE = pool_size
+
+if __name__ == '__main__':
+    main()
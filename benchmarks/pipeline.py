@@ -0,0 +1,280 @@
+"""
+End to end benchmark of the bridge message pipeline (without hardware)
+
+LogicDevice -> MessageServer pipe -> Hid_Device -> SimulatedTransport -> Hid_Device -> LogicDevice,
+scheduled by ThreadServer as the application does. Scenarios:
+
+    read        single register read, one command outstanding
+    dump        4 KB config read, split into SIZE_MAX HID transfers
+    irq         interrupt storm, T5 messages reported by the bridge after IRQ is set
+    devices     N devices in parallel, single register read on each
+
+Results are written as JSON (stdout by default, the log of the devices goes to stderr):
+
+    python -m benchmarks.pipeline [-n 2000] [--devices 4] [--latency 0] [-o result.json]
+"""
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import threading
+import time
+
+from benchmarks.message_alloc import AllocCounter
+from bus.hid_bus import Hid_Device
+from bus.simulated import MxtMemory, SimulatedTransport
+from server.message import DeadlineTimer, Message, ServerMessage, ThreadServer
+from ui.MainUi import LogicDevice
+
+VERSION = 1     # of the result format
+CONFIG_SIZE = 4096
+CONFIG_OBJECTS = MxtMemory.OBJECTS + ((71, 200, 21, 0), )     # enough config space to dump 4 KB
+T7_POWER = 7
+
+class Result(object):
+    "Statistics of one scenario, measured after the warm up commands are done"
+    def __init__(self, warmup):
+        self.warmup = warmup
+        self.latency = []
+        self.completed = 0
+        self.errors = 0
+        self.bytes = 0
+        self.start = self.cpu = None
+        self.elapsed = self.cpu_time = 0
+        self.alloc = self.alloc_count = None
+        self.counter = None
+        self.irq_ready = 0
+
+    def measure(self, counter):
+        self.counter = counter
+        if not self.warmup:
+            self.begin()
+
+    def begin(self):
+        self.latency = []
+        self.bytes = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+        self.cpu = time.process_time()
+        self.alloc = self.counter.count
+
+    def finish(self):
+        "stop measuring before the devices are stopped"
+        if self.start is None:  # stuck in warm up
+            self.begin()
+        self.elapsed = time.perf_counter() - self.start
+        self.cpu_time = time.process_time() - self.cpu
+        self.alloc_count = self.counter.count - self.alloc
+
+    def done(self, latency, size):
+        self.completed += 1
+        if self.start is not None:
+            self.latency.append(latency)
+            self.bytes += size
+        elif self.completed == self.warmup:
+            self.begin()
+
+    def error(self):
+        self.completed += 1
+        if self.start is not None:
+            self.errors += 1
+
+    def report(self, name, **params):
+        elapsed = self.elapsed
+        count = max(len(self.latency), 1)
+        latency = sorted(self.latency)
+
+        def percentile(p):
+            return latency[min(int(len(latency) * p / 100), len(latency) - 1)] * 1e3 if latency else None
+
+        return dict(name=name, params=params,
+                    commands=len(self.latency), errors=self.errors, seconds=elapsed,
+                    cmds_per_s=len(self.latency) / elapsed, bytes_per_s=self.bytes / elapsed,
+                    latency_ms=dict(p50=percentile(50), p90=percentile(90), p99=percentile(99),
+                                    max=latency[-1] * 1e3 if latency else None,
+                                    mean=sum(latency) / count * 1e3),
+                    cpu_us_per_cmd=self.cpu_time / count * 1e6,
+                    alloc_per_cmd=self.alloc_count / count)
+
+class BenchDevice(LogicDevice):
+    "LogicDevice records the replies into Result instead of printing"
+    def __init__(self, id, logic_phy_pipes, result):
+        super(BenchDevice, self).__init__(id, logic_phy_pipes)
+        self.result = result
+        self.posted = {}    # interrupt index: posted time
+
+    def handle_page_read_msg(self, seq, cmd, data):
+        value = data['value']
+        if len(value):
+            self.result.done(time.time() - cmd.time(), len(value))
+        else:
+            self.result.error()
+
+    def handle_page_write_msg(self, seq, cmd, data):
+        self.result.done(time.time() - cmd.time(), data['value'])
+
+    def handle_raw_data_msg(self, seq, cmd, data):
+        self.result.irq_ready += 1
+
+    def handle_nak_msg(self, seq, error):
+        self.result.error()
+
+    def handle_interrupt_data_msg(self, seq, data):
+        value = data['value']   # report id, payload...
+        index = int.from_bytes(bytes(value[1:5]), 'little')
+        self.result.done(time.time() - self.posted.pop(index), len(value))
+
+    def read(self, addr, size):
+        command = ServerMessage.alloc(Message.CMD_DEVICE_PAGE_READ, self.id(), self.next_seq(Message.seq_root()),
+                                      addr=addr, size=size)
+        self.prepare_command(command)
+
+    def set_irq(self, addr, size):
+        command = ServerMessage.alloc(Message.CMD_DEVICE_MSG_OUTPUT, self.id(), self.next_seq(Message.seq_root()),
+                                      addr=addr, size=size)
+        self.prepare_command(command)
+
+class Pipeline(object):
+    "N simulated bridges with Hid_Device and BenchDevice, driven by ThreadServer in the calling thread"
+    TIMEOUT = 60    #second, give up if the scenario is stuck
+
+    def __init__(self, name, devices, result, **transport_kwargs):
+        self.timer = DeadlineTimer()    # shared by the devices, as the bus timer
+        self.result = result
+        self.transports = []
+        self.phys = []
+        self.logics = []
+        for i in range(devices):
+            t = SimulatedTransport('{}:{}'.format(name, i), memory=MxtMemory(CONFIG_OBJECTS), seed=i,
+                                   **transport_kwargs)
+            dev = Hid_Device(t, timer=self.timer)
+            dev.start()
+            self.transports.append(t)
+            self.phys.append(dev)
+            self.logics.append(BenchDevice(dev.id(), dev.attach_info(), result))
+
+        self.issue = None
+        ThreadServer.register(self.__class__.__name__, self.process,
+                              pipes=[logic.logic_pipe for logic in self.logics], interval=None)
+
+    def stop(self):
+        ThreadServer.unregister(self.__class__.__name__, self.process)
+        for dev in self.phys:
+            dev.stop()
+        self.timer.close()
+
+    def process(self):
+        for logic in self.logics:
+            while logic.logic_pipe.poll(0):
+                msg = logic.logic_pipe.recv()
+                logic.handle_message(msg)
+                msg.release()
+
+            if self.issue:
+                self.issue(logic)
+            logic.send_command()
+
+    def run(self, until):
+        deadline = time.time() + self.TIMEOUT
+        ThreadServer.wakeup(self.__class__.__name__, self.process)
+        while not until() and time.time() < deadline:
+            ThreadServer.process()
+            ThreadServer.wait(0.1)
+
+def closed_loop(name, count, warmup, devices, window, addr, size, **transport_kwargs):
+    "each device keeps window commands outstanding until count commands done in total"
+    result = Result(warmup)
+    total = count + warmup
+    issued = [0]
+
+    def issue(logic):
+        while len(logic.cmd_list) < window and issued[0] < total:
+            logic.read(addr, size)
+            issued[0] += 1
+
+    pipe = Pipeline(name, devices, result, **transport_kwargs)
+    pipe.issue = issue
+    with AllocCounter() as counter:
+        result.measure(counter)
+        pipe.run(lambda: result.completed >= total)
+        result.finish()
+    pipe.stop()
+    return result
+
+def interrupt_storm(name, count, warmup, rate, **transport_kwargs):
+    "set IRQ to T5, then the chip posts messages at rate (0 for as fast as possible)"
+    result = Result(warmup)
+    total = count + warmup
+    pipe = Pipeline(name, 1, result, **transport_kwargs)
+    t, logic = pipe.transports[0], pipe.logics[0]
+    t5_addr, t5_size, instances, report_id = t.memory.objects[MxtMemory.GEN_MESSAGE_T5]
+    logic.set_irq(t5_addr, t5_size)
+    pipe.run(lambda: result.irq_ready)
+
+    def storm():
+        for i in range(total):
+            logic.posted[i] = time.time()
+            t.interrupt(payload=i.to_bytes(4, 'little') + bytes(t5_size - 5))
+            if rate:
+                time.sleep(1.0 / rate)
+
+    with AllocCounter() as counter:
+        result.measure(counter)
+        thread = threading.Thread(target=storm, name='storm')
+        thread.start()
+        pipe.run(lambda: result.completed >= total)
+        result.finish()
+        thread.join()
+    pipe.stop()
+    return result
+
+def run(args):
+    "run the scenarios of the parsed arguments, return the report dict"
+    transport_kwargs = dict(latency=args.latency, jitter=args.jitter, loss=args.loss)
+    t7 = MxtMemory(CONFIG_OBJECTS).object_address(T7_POWER)    # T7 and the following config objects
+    dump_count = max(args.n // 20, 1)
+    scenarios = dict(
+        read=lambda: closed_loop('read', args.n, args.warmup, 1, args.window, t7, 1, **transport_kwargs)
+            .report('read', size=1, window=args.window, **transport_kwargs),
+        dump=lambda: closed_loop('dump', dump_count, 2, 1, 1, t7, CONFIG_SIZE, **transport_kwargs)
+            .report('dump', size=CONFIG_SIZE, **transport_kwargs),
+        irq=lambda: interrupt_storm('irq', args.n, args.warmup, args.rate, **transport_kwargs)
+            .report('irq', rate=args.rate, **transport_kwargs),
+        devices=lambda: closed_loop('devices', args.n, args.warmup, args.devices, args.window, t7, 1,
+                                    **transport_kwargs)
+            .report('devices', devices=args.devices, size=1, window=args.window, **transport_kwargs),
+    )
+
+    results = [scenarios[name]() for name in args.scenario or ('read', 'dump', 'irq', 'devices')]
+    return dict(version=VERSION, python=platform.python_version(), platform=platform.platform(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'), scenarios=results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=2000, help='commands (or interrupts) measured each scenario')
+    parser.add_argument('--warmup', type=int, default=100, help='commands before measuring')
+    parser.add_argument('--devices', type=int, default=4, help='devices of the parallel scenario')
+    parser.add_argument('--window', type=int, default=1, help='outstanding commands each device')
+    parser.add_argument('--rate', type=float, default=0, help='interrupts per second, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=0, help='bridge response latency, second')
+    parser.add_argument('--jitter', type=float, default=0, help='bridge response jitter, second')
+    parser.add_argument('--loss', type=float, default=0, help='bridge response loss rate')
+    parser.add_argument('--scenario', action='append', choices=('read', 'dump', 'irq', 'devices'),
+                        help='run only these scenarios, could be repeated')
+    parser.add_argument('-o', '--output', help='JSON result file, stdout if not set')
+    args = parser.parse_args(argv)
+
+    with contextlib.redirect_stdout(sys.stderr):    # the log of the devices, keep stdout for the JSON
+        report = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -6,22 +6,33 @@
 Show all HID devices information
 """
 
-from multiprocessing import RLock
+from threading import RLock
 #from multiprocessing import Process, Pipe, RLock
 #from multiprocessing.connection import wait
 import sys
 import array
 import time
+from collections import deque, OrderedDict
 
 #from bus.manage import Bus, BusManager
 from bus.manage import PhyDevice, Bus
+from bus.hotplug import NetlinkHotplug
+from bus.transport import HID_EVT_ALL, find_hidraw_devices
 from server.message import BaseMessage, Message, HidMessage, MessageServer, ThreadServer
 from dotdict import Dotdict
 
-import bus.pywinusb.hid as usbhid
-from bus.pywinusb.hid import tools
+try:
+    import bus.pywinusb.hid as usbhid
+    from bus.pywinusb.hid import tools
+    from bus.winusb_transport import PyWinUsbTransport, HidPnPHotplug
+except ImportError: # not windows, hidraw transport only
+    usbhid = None
 
 class HidCommand(Message):
+    __slots__ = ('usage', '_repeat_value', 'repeat_count', 'trans_size', 'op', '__raw_data',
+                 'addr', 'total', 'offset', 'buffer', 'deadline')
+    _pool = []
+
     NAME = 'HID cmd'
 
     """
@@ -47,6 +58,7 @@ class HidCommand(Message):
 
     TIMEOUT = 1 #second
     SIZE_MAX = {'r': 63, 'w': 59}
+    ADDRESS_SPACE = 0x10000 #16 bits register address
     #SIZE_PROPER = {'r': 64, 'w': 48}
 
     R = Dotdict({'RESPONSE_OK': 0})
@@ -57,9 +69,10 @@ class HidCommand(Message):
         self.usage = kwargs.pop('usage')
 
         self._repeat_value = kwargs.pop('repeat', None)
+        self.repeat_count = 0
         if self.repeatable():
             #self._repeat = True
-            self.repeat_count = 0
+            pass
         # else:
         #     self._repeat = False
 
@@ -67,6 +80,10 @@ class HidCommand(Message):
 
         super(HidCommand, self).__init__(HidCommand.NAME, type, 0, seq, **kwargs)
 
+        self.addr = None
+        self.total = self.offset = 0
+        self.buffer = None
+        self.deadline = None    # entry in bus timer
         value = []
         if type == HidCommand.CMD_TEST:
             #[type, 0, value]
@@ -74,21 +91,21 @@ class HidCommand(Message):
             self.trans_size = 0
             self.op = 'w'
         elif type == HidCommand.CMD_WRITE_READ:
-            addr_l, addr_h = kwargs['addr'].to_bytes(2, byteorder='little')
+            self.addr = kwargs['addr']
             if 'size' in kwargs.keys(): #only read need explicit size
-                #[type, LenW=2, LenR, AddrL, AddrH]
-                trans_size = self.to_trans_size(kwargs['size'], 'r')
-                value = [type, 2, trans_size, addr_l, addr_h]
+                self.total = kwargs['size']
                 self.op = 'r'
             else:
-                #write #[type, LenW, LenR=0, AddrL, AddrH, Data0, Data1, ...]
-                #addr_l, addr_h = kwargs['addr'].to_bytes(2, byteorder='little')
-                data = kwargs['value']
-                trans_size = self.to_trans_size(len(data), 'w')
-                value = [type, trans_size + 2, 0, addr_l, addr_h]
-                value.extend(data[:trans_size])
+                self.total = len(kwargs['value'])
                 self.op = 'w'
-            self.trans_size = trans_size
+            if self.addr < 0 or self.addr + self.total > HidCommand.ADDRESS_SPACE:
+                # no data to send, the command fails and naks
+                print(self.__class__.__name__, "block over address space: addr {} size {}".format(
+                    self.addr, self.total))
+                self.trans_size = 0
+            else:
+                self.rewind()
+                value = self.chunk_data()
         elif type == HidCommand.CMD_RAW:
             value = kwargs['value']
             self.trans_size = self.to_trans_size(len(value), 'w')
@@ -119,7 +136,7 @@ class HidCommand(Message):
         return 'size_r' in self.kwargs.keys()
 
     def to_trans_size(self, size, op):
-        "for HID protocal, there is read/write limit, so we may couldn't write through one time"
+        "for HID protocal, there is read/write limit, so large block is split into chunks"
         max_size = HidCommand.SIZE_MAX[op]
         if size > max_size:
             return max_size
@@ -141,6 +158,36 @@ class HidCommand(Message):
     def transfered_size(self):
         return self.trans_size
 
+    def rewind(self):
+        "back to the first chunk, read chunks are filled into the preallocated buffer"
+        self.offset = 0
+        if self.op == 'r':
+            self.buffer = bytearray(self.total)
+
+    def chunk_data(self):
+        "command data of current chunk"
+        addr_l, addr_h = (self.addr + self.offset).to_bytes(2, byteorder='little')
+        self.trans_size = self.to_trans_size(self.total - self.offset, self.op)
+        if self.op == 'r':
+            #[type, LenW=2, LenR, AddrL, AddrH]
+            return [HidCommand.CMD_WRITE_READ, 2, self.trans_size, addr_l, addr_h]
+        else:
+            #write #[type, LenW, LenR=0, AddrL, AddrH, Data0, Data1, ...]
+            data = self.extra_info()['value']
+            value = [HidCommand.CMD_WRITE_READ, self.trans_size + 2, 0, addr_l, addr_h]
+            value.extend(data[self.offset: self.offset + self.trans_size])
+            return value
+
+    def next_chunk(self, size):
+        "move forward after a chunk transfered, return False if the whole block is done"
+        self.offset += size
+        if not size or self.offset >= self.total:
+            return False
+
+        self.__raw_data = array.array('B', self.chunk_data())
+        self.set_status(Message.INIT)  # send immediately
+        return True
+
     # def delay(self):
     #     return self._delay
 
@@ -167,6 +214,10 @@ class HidCommand(Message):
         else:
             self.repeat_count = 0
 
+        if self.type() == HidCommand.CMD_WRITE_READ and self.offset:
+            self.rewind()
+            self.__raw_data = array.array('B', self.chunk_data())
+
         self.set_status(status)
 
     def ready(self):
@@ -175,6 +226,12 @@ class HidCommand(Message):
     def raw_data(self):
         return self.__raw_data
 
+    def release(self):
+        self.__raw_data = None
+        self.buffer = None
+        self.deadline = None
+        super(HidCommand, self).release()
+
     def parent_type(self):
         info = self.extra_info()
         if 'parent_type' in info.keys():
@@ -191,12 +248,11 @@ class HidCommand(Message):
             self.set_status(Message.SEND)
             if self.raw_data():
                 #print(self.__class__.__name__, "send:", self.msg_data(), list(map(hex, self.raw_data())))
-                raw_data = self.to_trans_format(self.raw_data(), len(pipe[Hid_Device.USAGE_ID_OUTPUT]))
+                raw_data = self.to_trans_format(self.raw_data(), pipe.output_report_size())
                 #print(list(map(hex, raw_data)))
                 try:
-                    pipe.set_raw_data(raw_data)
-                    pipe.send()
-                    return True
+                    if pipe.write_report(raw_data):
+                        return True
                 except:
                     print(self.__class__.__name__, "Send HID Message: Failed")
 
@@ -205,38 +261,50 @@ class HidCommand(Message):
         return False
 
 class PhyMessage(Message):
+    __slots__ = ('lock', )
+    _pool = []
+
     #hid message type
     (MSG_HID_RAW_DATA, MSG_HID_SIMULATED) = range(600, 602)
     HID_DEVICE = 'HID Device'
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, lock=None, **kwargs):
+        self.lock = lock    # report lock of the device, the devices send reports in parallel
         super(PhyMessage, self).__init__(PhyMessage.HID_DEVICE, *args, **kwargs)
-        self.report_lock = RLock()
+
+    def release(self):
+        self.lock = None
+        super(PhyMessage, self).release()
 
     def send(self):
         #print("PhyMessage send")
-        self.report_lock.acquire()
+        if not self.lock:
+            return super(PhyMessage, self).send()
 
-        result = super(PhyMessage, self).send()
-        self.report_lock.release()
-
-        return result
+        with self.lock:
+            return super(PhyMessage, self).send()
 
 class Hid_Device(PhyDevice):
 
     VID_PID_LIST = [(0x03eb, 0x6123)]  #vid/pid
     (HID_EVENT_ID, HID_EVENT_SIMULATED_ID) = (1, 999)   #True is return from hid.core if there is event
 
-    USAGE_ID_INPUT = usbhid.get_full_usage_id(0xffff, 0x03)
-    USAGE_ID_OUTPUT = usbhid.get_full_usage_id(0xffff, 0x05)
-    CMD_STACK_DEPTH = 2
+    USAGE_ID_INPUT = 0xffff0003     #vendor page 0xffff, usage 0x03
+    USAGE_ID_OUTPUT = 0xffff0005
+    CMD_QUEUE_DEPTH = 16    #commands queued in device, the others are kept in pipe until queue has space
+    CMD_PIPELINE = 1    #outstanding commands in hardware, >1 only if bridge firmware responses in order
     CMD_TIMEOUT = 0.5 #timeout of command
 
     def __init__(self, *args, **kwargs):
-        super(Hid_Device, self).__init__(*args, **kwargs)
-        self.report_in = None
-        self.report_out = None
-        self.hid_cmd = []   #only support 1 command depth by hardware
+        self.queue_depth = kwargs.pop('queue_depth', self.CMD_QUEUE_DEPTH)
+        self.pipeline = kwargs.pop('pipeline', self.CMD_PIPELINE)
+        super(Hid_Device, self).__init__(*args, **kwargs)    # phy is the Transport
+        self.hid_cmd = OrderedDict()   #command queue in FIFO order, indexed by seq key
+        self.in_flight = deque()    #sent commands in sending order, response matches the first one
+        self.ready_cmd = deque()    #commands could be sent, in FIFO order
+        self.cmd_lock = RLock() #command queue is accessed by hid report thread
+        self.report_lock = RLock()  #report pipe of this device
+        self.busy = False
         # parent, client = Pipe(duplex=False)
         # self.pipe_hid_event = client
         # self.pipe_hid_recv = parent
@@ -247,35 +315,21 @@ class Hid_Device(PhyDevice):
         # self.pipe_hid_recv.close()
         #super(Hid_Device, self).__del__()
 
-    def start(self, default_pipe):
+    def start(self, default_pipe=None):
         super(Hid_Device, self).start(default_pipe)
         self.open_dev()
 
-    def stop(self, default_pipe):
+    def stop(self, default_pipe=None):
         self.close_dev()
+        with self.cmd_lock:
+            for cmd in self.hid_cmd.values():
+                self.timer.cancel(cmd.deadline)
         super(Hid_Device, self).stop(default_pipe)
 
     def open_dev(self):
-        self.phy.open()
-
-        for report in self.phy.find_output_reports():
-            #print(report)
-            if self.USAGE_ID_OUTPUT in report:
-                self.report_out = report
-                break
-
-        for report in self.phy.find_input_reports():
-            if self.USAGE_ID_INPUT in report:
-                self.report_in = report
-                break
-
-        # self.phy.add_event_handler(self.USAGE_ID_INPUT,
-        #                            self.phy_event_handler, usbhid.HID_EVT_ALL)  # level usage
-
         self.phy.set_raw_data_handler(self.phy_raw_data_handler)
-
-        print("HID report out: {}".format(self.report_out))
-        print("HID report in: {}".format(self.report_in))
+        self.phy.set_raw_batch_handler(self.phy_raw_batch_handler)
+        self.phy.open()
 
     def close_dev(self):
         self.phy.close()
@@ -289,7 +343,7 @@ class Hid_Device(PhyDevice):
         value = msg.value()
 
         attached = cmd_data[0] == value[0]
-        return HidMessage(Message.MSG_BRIDGE_ATTACH, self.id(), seq, value=attached,
+        return HidMessage.alloc(Message.MSG_BRIDGE_ATTACH, self.id(), seq, value=attached,
                 pipe=self.logic_pipe())
 
     def handle_phy_rw_message(self, cmd, msg):
@@ -308,19 +362,23 @@ class Hid_Device(PhyDevice):
         if (not status and not size):
             return
 
+        # large block is transfered chunk by chunk, return True if more chunk to go, reply once when done
         if op == 'r' and cmd_data[2]:   # command data[2] is readsize
             if status == RW_OK and size <= cmd.transfered_size():
-                result = value[2: size + 2]
+                cmd.buffer[cmd.offset: cmd.offset + size] = value[2: size + 2]
+                if cmd.next_chunk(size):
+                    return True
+                result = cmd.buffer
             else:
                 result = []
-            return HidMessage(type, self.id(), seq, value=result,
+            return HidMessage.alloc(type, self.id(), seq, value=result,
                     pipe=self.logic_pipe())
         elif op == 'w':
             if status == W_ONLY_OK and cmd.transfered_size() >= size:
-                result = size
-            else:
-                result = 0
-            return HidMessage(type, self.id(), seq, value=result,
+                if cmd.next_chunk(cmd.transfered_size()):
+                    return True
+            result = cmd.offset    # size written
+            return HidMessage.alloc(type, self.id(), seq, value=result,
                     pipe=self.logic_pipe())
 
     def handle_phy_raw_message(self, cmd, msg):
@@ -328,8 +386,8 @@ class Hid_Device(PhyDevice):
         seq = cmd.seq()  # to parent seq
         seq.pop()
 
-        value = msg.value()
-        return HidMessage(type, self.id(), seq, value=value,
+        value = bytearray(msg.value())  # the raw report is only valid in the handler
+        return HidMessage.alloc(type, self.id(), seq, value=value,
                       pipe=self.logic_pipe())
 
     def handle_phy_ouput_message(self, cmd, msg):
@@ -346,7 +404,7 @@ class Hid_Device(PhyDevice):
         else:
             result = False
 
-        return HidMessage(type, self.id(), seq, value=result,
+        return HidMessage.alloc(type, self.id(), seq, value=result,
                       pipe=self.logic_pipe())
 
     def handle_phy_interrupt_message(self, msg):
@@ -357,24 +415,27 @@ class Hid_Device(PhyDevice):
         #print(self.__class__.__name__, "int", msg)
         value = msg.value()
         if value[0] == 0x9A and value[1] == RW_OK:
-            return HidMessage(type, self.id(), seq, value=value[2:],
-                          pipe=self.logic_pipe()).send()
+            reply = HidMessage.alloc(type, self.id(), seq, value=bytearray(value[2:]), pipe=self.logic_pipe())
+            result = reply.send()
+            reply.release()
+            return result
         else:
-            print(self.__class__.__name__, "Invalid irq message:", value)
+            print(self.__class__.__name__, "Invalid irq message:", list(value))
 
     def handle_phy_nak_message(self, cmd):
         seq = cmd.seq()  # to parent seq
         seq.pop()
-        HidMessage(Message.MSG_DEVICE_NAK, self.id(), seq, pipe=self.logic_pipe()).send()
+        reply = HidMessage.alloc(Message.MSG_DEVICE_NAK, self.id(), seq, pipe=self.logic_pipe())
+        reply.send()
+        reply.release()
 
     def handle_phy_message(self, msg):
         #print(self.__class__.__name__, "handle_phy_message")
 
-
-
-        result = None
-        for i, cmd in enumerate(self.hid_cmd[:]):
-            if cmd.is_status(Message.SEND): # PhyMessage.MSG_HID_RAW_DATA
+        with self.cmd_lock:
+            result = None
+            cmd = self.in_flight[0] if self.in_flight else None
+            if cmd: # PhyMessage.MSG_HID_RAW_DATA
                 #print(self.__class__.__name__, "cmd:", cmd)
                 #print(self.__class__.__name__, "msg:", msg)
 
@@ -389,103 +450,145 @@ class Hid_Device(PhyDevice):
                 else:
                     print(self.__class__.__name__, "Unhandled cmd message", cmd, msg)
 
-                if result:
-                    self.hid_cmd.pop(i)
+                if result is True:  # next chunk, keep the command in queue
+                    self.in_flight.popleft()
+                    self.timer.cancel(cmd.deadline)
+                    self.ready_cmd.appendleft(cmd)
+                    self.send_command()
+                    return
+                elif result:
+                    self.in_flight.popleft()
+                    self.timer.cancel(cmd.deadline)
+                    del self.hid_cmd[cmd.seq_key()]
                     result.send()
+                    result.release()
 
-                break
-
-            elif cmd.is_status(Message.ERROR): # PhyMessage.MSG_HID_SIMULATED
-                print(self.__class__.__name__, "cmd error:", cmd)
-                self.hid_cmd.pop(i)
-                result = False
-                break
-
-        if result:
-            if cmd.repeatable():  # repeatable message added in
-                cmd.reset_repeat(Message.REPEAT)
-                self.hid_cmd.append(cmd)
-        else:
-            if result is None:
-                self.handle_phy_interrupt_message(msg)
+            if result:
+                if cmd.repeatable():  # repeatable message added in
+                    cmd.reset_repeat(Message.REPEAT)
+                    self.hid_cmd[cmd.seq_key()] = cmd
+                    cmd.deadline = self.timer.add(cmd._repeat_value, self.repeat_command, cmd)
+                else:
+                    cmd.release()
             else:
-                print(self.__class__.__name__, "Unknow phy msg:", msg)
-                self.handle_phy_nak_message(cmd)
+                self.handle_phy_interrupt_message(msg)
 
     def phy_event_handler(self, raw_data, event_type):  # this may be a asyn thread/process, need lock report pipe
         "simple usage control handler"
 
         #print("HID PHY EVENT:", event_type, raw_data)
 
-        msg = PhyMessage(PhyMessage.MSG_HID_RAW_DATA, self.id(), Message.seq_root(), event=event_type,
-                         value=array.array('B', raw_data[1:]))
+        # value is a view of the report, not valid after the handler returned
+        msg = PhyMessage.alloc(PhyMessage.MSG_HID_RAW_DATA, self.id(), Message.seq_root(), event=event_type,
+                         value=memoryview(raw_data)[1:], lock=self.report_lock)
         self.handle_phy_message(msg)
+        msg.release()
+        self.wakeup()   # next command could be sent
 
     def phy_raw_data_handler(self, raw_data):
-        self.phy_event_handler(raw_data, usbhid.HID_EVT_ALL)
+        self.phy_event_handler(raw_data, HID_EVT_ALL)
+
+    def phy_raw_batch_handler(self, raw_list):
+        "reports arrived together (e.g. interrupt burst) are handled in one lock and one wakeup"
+        with self.cmd_lock:
+            for raw_data in raw_list:
+                msg = PhyMessage.alloc(PhyMessage.MSG_HID_RAW_DATA, self.id(), Message.seq_root(), event=HID_EVT_ALL,
+                                       value=memoryview(raw_data)[1:], lock=self.report_lock)
+                self.handle_phy_message(msg)
+                msg.release()
+        self.wakeup()
 
     def hid_proc_poll_command(self, type, seq, extra_info):
         "Test command 1"
 
-        command = HidCommand(HidCommand.CMD_TEST, self.next_seq(seq),
+        command = HidCommand.alloc(HidCommand.CMD_TEST, self.next_seq(seq),
                          value=0xca, parent_type=type, **extra_info,
-                         pipe=self.report_out, usage=Hid_Device.USAGE_ID_OUTPUT)
+                         pipe=self.phy, usage=Hid_Device.USAGE_ID_OUTPUT)
 
         self.prepare_command(command)
 
     def hid_proc_block_read_command(self, type, seq, data):
-        cmd = HidCommand(HidCommand.CMD_WRITE_READ, self.next_seq(seq),
+        cmd = HidCommand.alloc(HidCommand.CMD_WRITE_READ, self.next_seq(seq),
                          addr=data['addr'], size=data['size'], parent_type=type,
-                         pipe=self.report_out, usage=Hid_Device.USAGE_ID_OUTPUT)
+                         pipe=self.phy, usage=Hid_Device.USAGE_ID_OUTPUT)
         self.prepare_command(cmd)
 
     def hid_proc_block_write_command(self, type, seq, data):
-        cmd = HidCommand(HidCommand.CMD_WRITE_READ, self.next_seq(seq),
+        cmd = HidCommand.alloc(HidCommand.CMD_WRITE_READ, self.next_seq(seq),
                          addr=data['addr'], value=data['value'], parent_type=type,
-                         pipe=self.report_out, usage=Hid_Device.USAGE_ID_OUTPUT)
+                         pipe=self.phy, usage=Hid_Device.USAGE_ID_OUTPUT)
         self.prepare_command(cmd)
 
     def hid_proc_raw_data_command(self, type, seq, data):
-        cmd = HidCommand(HidCommand.CMD_RAW, self.next_seq(seq),
+        cmd = HidCommand.alloc(HidCommand.CMD_RAW, self.next_seq(seq),
                          value=data['value'], parent_type=type,
-                         pipe=self.report_out, usage=Hid_Device.USAGE_ID_OUTPUT)
+                         pipe=self.phy, usage=Hid_Device.USAGE_ID_OUTPUT)
         self.prepare_command(cmd)
 
     def hid_proc_msg_output_command(self, type, seq, data):
-        cmd = HidCommand(HidCommand.CMD_IRQ, self.next_seq(seq),
+        cmd = HidCommand.alloc(HidCommand.CMD_IRQ, self.next_seq(seq),
                          addr=data['addr'], size=data['size'], parent_type=type,
-                         pipe=self.report_out, usage=Hid_Device.USAGE_ID_OUTPUT)
+                         pipe=self.phy, usage=Hid_Device.USAGE_ID_OUTPUT)
         self.prepare_command(cmd)
 
     def prepare_command(self, command):
-        if len(self.hid_cmd) >= Hid_Device.CMD_STACK_DEPTH:
-            print("Hid has command in list: {}".format(self.hid_cmd))
-            cmd = self.hid_cmd.pop()
-            self.handle_phy_nak_message(cmd)
-
         #print(self.__class__.__name__, "prepare_command", command)
-        self.hid_cmd.append(command)
-
-    def handle_timeout_command(self):
-        for cmd in self.hid_cmd[:]:
-            if cmd.is_status(Message.SEND):
-                if cmd.timeout(Hid_Device.CMD_TIMEOUT):
-                    print("HID command timeout: {}".format(cmd))
-                    self.hid_cmd.remove(cmd)
-                    self.handle_phy_nak_message(cmd)
+        with self.cmd_lock:
+            self.hid_cmd[command.seq_key()] = command
+            self.ready_cmd.append(command)
+
+    def queue_full(self):
+        return len(self.hid_cmd) >= self.queue_depth
+
+    def set_busy(self, busy):
+        "backpressure: tell logic device to hold the commands when queue is full"
+        if busy != self.busy:
+            self.busy = busy
+            reply = HidMessage.alloc(Message.MSG_DEVICE_BUSY, self.id(), Message.seq_root(), value=busy,
+                                     pipe=self.logic_pipe())
+            reply.send()
+            reply.release()
+
+    def remove_command(self, cmd):
+        with self.cmd_lock:
+            if self.in_flight and self.in_flight[0] is cmd:
+                self.in_flight.popleft()
+            elif cmd in self.in_flight:
+                self.in_flight.remove(cmd)
+            del self.hid_cmd[cmd.seq_key()]
+            self.timer.cancel(cmd.deadline)
+        self.handle_phy_nak_message(cmd)
+        cmd.release()
+
+    def handle_timeout_command(self, cmd):
+        "bus timer callback of the in flight command"
+        with self.cmd_lock:
+            # the response may arrived before the lock, then the command is done or sent again
+            if cmd in self.in_flight and cmd.timeout(Hid_Device.CMD_TIMEOUT):
+                print("HID command timeout: {}".format(cmd))
+                self.remove_command(cmd)
+        self.wakeup()
+
+    def repeat_command(self, cmd):
+        "bus timer callback of the repeatable command"
+        with self.cmd_lock:
+            if cmd.is_status(Message.REPEAT):
+                cmd.set_status(Message.INIT)
+                self.ready_cmd.append(cmd)
+        self.wakeup()
 
     def send_command(self):
         #print("{} send command (has {} cmd in list)".format(self.__class__.__name__, len(self.hid_cmd)))
 
-        pending = any(map(lambda c: c.is_status(Message.SEND), self.hid_cmd))
-        if pending:
-            #print(self.__class__,__name__, "pending {} command".format(len(self.hid_cmd)), self.hid_cmd)
-            pass
-        else:
-            for cmd in self.hid_cmd:
-                if cmd.ready():
-                    cmd.send() #send 1 only each time
-                    break
+        with self.cmd_lock:
+            while self.ready_cmd and len(self.in_flight) < self.pipeline:
+                cmd = self.ready_cmd.popleft()
+                if cmd.send():
+                    self.in_flight.append(cmd)
+                    cmd.deadline = self.timer.add(Hid_Device.CMD_TIMEOUT, self.handle_timeout_command, cmd)
+                else:
+                    print(self.__class__.__name__, "cmd error:", cmd)
+                    self.remove_command(cmd)
 
     def handle_bus_command(self, msg):
         type = msg.type()
@@ -508,19 +611,9 @@ class Hid_Device(PhyDevice):
             print("Unknown message type {}".format(type))
 
     def poll_interval(self):
-        wait_list = []
-        if len(self.hid_cmd):
-            wait_list.append(Hid_Device.CMD_TIMEOUT)   #command timeout
-
-            for cmd in self.hid_cmd:
-                t = cmd.delay_time()
-                if t is not None:
-                    wait_list.append(t)
-
-        if len(wait_list):
-            interval = min(wait_list)
-            #print(self.__class__.__name__, "Polling interval {:0.2} [{}]".format(interval, wait_list))
-            return interval
+        # command timeout and repeat are watched by bus timer, which wakes up the device when due
+        if self.ready_cmd and len(self.in_flight) < self.pipeline:
+            return 0
 
         #print(self.__class__.__name__, "Pause")
         #return None for infinite
@@ -532,8 +625,9 @@ class Hid_Device(PhyDevice):
         close_handle = False
         if not close_handle:
             #try:
-            for r in MessageServer.wait(all_pipes, timeout=self.poll_interval()):
-                if r:
+            # ThreadServer has slept poll_interval() or woken by the pipe, so not block here
+            for r in MessageServer.wait(all_pipes, timeout=0):
+                while r.poll() and not self.queue_full():    # leave the commands in pipe if queue is full
                     try:
                         msg = r.recv()
                     except EOFError:
@@ -547,6 +641,7 @@ class Hid_Device(PhyDevice):
                     #print("Process<{}> get: {}".format(self.__class__.__name__, msg))
 
                     self.handle_bus_command(msg)
+                    msg.release()
                     # location = msg.loc()
                     # if location == PhyMessage.HID_DEVICE:
                     #     #self.handle_phy_message(msg)
@@ -556,27 +651,40 @@ class Hid_Device(PhyDevice):
                     #     pass
 
             self.send_command()
-            self.handle_timeout_command()
+            self.set_busy(self.queue_full())
 
 class Hid_Bus(Bus):
 
     def __init__(self):
         super(Hid_Bus, self).__init__()
 
+    def hotplug_source(self):
+        if usbhid:
+            return HidPnPHotplug()
+        elif sys.platform.startswith('linux'):
+            return NetlinkHotplug()
+
     def create_new_device(self, *args, **kwargs):
         #super(Hid_Bus, self).create_new_device(args, kwargs)
-        return Hid_Device(*args, **kwargs)
+        return Hid_Device(*args, timer=self.timer, **kwargs)
 
     def refresh(self):
         phys = []
         for vid_pid in Hid_Device.VID_PID_LIST:
-            phys.extend(self.show_hids(*vid_pid))
+            if usbhid:
+                phys.extend(PyWinUsbTransport(dev) for dev in self.show_hids(*vid_pid))
+            else:
+                phys.extend(find_hidraw_devices(*vid_pid))
 
         #print(phys)
         return phys
 
     def show_hids(self, target_vid=0, target_pid=0, output=None):
-        """Check all HID devices conected to PC hosts."""
+        """Check all HID devices conected to PC hosts, pywinusb devices on windows, hidraw transports (not opened)
+           on the others"""
+        if not usbhid:
+            return find_hidraw_devices(target_vid, target_pid)
+
         # first be kind with local encodings
         if not output:
             # beware your script should manage encodings
@@ -635,6 +743,12 @@ if __name__ == '__main__':
             if devices:
                 print("Found HID class devices!, writting details...")
                 for dev in devices:
+                    if not usbhid:  # hidraw transport
+                        output.write('\n  Path:      %s\n' % dev.path)
+                        output.write('\n  Instance:  %s\n' % dev.instance_id)
+                        output.write('\n  Port (ID): %s\n' % dev.parent_instance_id)
+                        continue
+
                     device_name = str(dev)
                     output.write(device_name)
                     output.write('\n\n  Path:      %s\n' % dev.device_path)
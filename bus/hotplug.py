@@ -0,0 +1,87 @@
+"""
+Hotplug sources of the bus, tell the bus device arrived or removed, so enumeration is only done on change.
+
+A source calls the callback (no argument, may be in any thread) when something changed on the bus,
+the bus will refresh() once for several events come together.
+"""
+import socket
+import threading
+
+class HotplugSource(object):
+    "Base of hotplug source, the bus without source is polled by BusManager"
+    def __init__(self):
+        self.callback = None
+
+    def start(self, callback):
+        self.callback = callback
+
+    def stop(self):
+        self.callback = None
+
+    def notify(self):
+        callback = self.callback
+        if callback:
+            callback()
+
+class SimulatedHotplug(HotplugSource):
+    "Events are generated by calling arrive()/remove(), for test without hardware"
+    def arrive(self):
+        self.notify()
+
+    def remove(self):
+        self.notify()
+
+class NetlinkHotplug(HotplugSource):
+    "Kernel uevent from netlink socket (the source of udev), linux only"
+    NETLINK_KOBJECT_UEVENT = 15
+    KERNEL_GROUP = 1
+    RECV_SIZE = 8192
+    STOP_POLL = 0.5 #second, recv timeout to check stop()
+    ACTIONS = (b'add', b'remove')
+
+    def __init__(self, subsystems=(b'hidraw', )):
+        super(NetlinkHotplug, self).__init__()
+        self.subsystems = subsystems
+        self.sock = None
+        self.thread = None
+
+    def start(self, callback):
+        super(NetlinkHotplug, self).start(callback)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+        self.sock.bind((0, self.KERNEL_GROUP))
+        self.sock.settimeout(self.STOP_POLL)
+        self.thread = threading.Thread(target=self.run, name='hotplug:netlink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        super(NetlinkHotplug, self).stop()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def parse(self, data):
+        "'ACTION@DEVPATH\\0KEY=VALUE\\0...' to dict"
+        event = {}
+        for field in data.split(b'\0'):
+            key, sep, value = field.partition(b'=')
+            if sep:
+                event[key] = value
+        return event
+
+    def run(self):
+        while self.callback:
+            try:
+                data = self.sock.recv(self.RECV_SIZE)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                print(self.__class__.__name__, "recv failed:", e)
+                break
+
+            event = self.parse(data)
+            if event.get(b'ACTION') in self.ACTIONS and event.get(b'SUBSYSTEM') in self.subsystems:
+                self.notify()
@@ -1,21 +1,28 @@
 from abc import abstractmethod
 #from multiprocessing import Process, Pipe
+import multiprocessing
+from collections import OrderedDict
+import threading
 import time
 
-from server.message import Message, BusMessage, Token, MessageServer, ThreadServer
+from server.message import Message, BusMessage, Token, MessageServer, ThreadServer, DeadlineTimer
+from server.shmring import ShmChannel, ShmPipe
 
 class PhyDevice(object):
     "Each Device is a Hardware device, will running in a individual process()"
-    def __init__(self, physical):
+    def __init__(self, physical, timer=None):
         self.phy = physical
+        self.own_timer = not timer  # closed when the device stopped, the bus timer is kept
+        self.timer = timer if timer else DeadlineTimer()    # deadlines of the commands
         #self.cmd_pipe = None
         self.pipe_device_to_logic = None
         self.pipe_logic_to_device = None
         self.cmd_seq = 0
         #self.p = Process(target=self.process)
 
-    def start(self, default_pipe):
+    def start(self, default_pipe=None):
         # send the parent_pipe to server, then server will connect this pipe to send command
+        # default_pipe is None if the bus reports the attach in batch with attach_info()
 
         #parent_pipe, client_pipe = Pipe(duplex=True) #only use server send message to device. The opposite direction is transfer by default pipe.
         #self.pipe_device_to_logic = parent_pipe
@@ -23,18 +30,26 @@ class PhyDevice(object):
         self.pipe_device_to_logic = MessageServer.open('phy_to_logic:' + self.id())
         self.pipe_logic_to_device = MessageServer.open('logic_to_phy:'  + self.id())
 
-        ThreadServer.register(self.__class__.__name__, self.process)
-        BusMessage(Message.MSG_BUS_FOUND, self.id(), Token(self.cmd_seq),
-                value=(self.pipe_device_to_logic, self.pipe_logic_to_device), pipe=default_pipe).send()
+        ThreadServer.register(self.__class__.__name__, self.process,
+                              interval=self.poll_interval, pipes=(self.phy_pipe(), ))
+        if default_pipe:
+            BusMessage(Message.MSG_BUS_FOUND, self.id(), Token(self.cmd_seq),
+                    value=self.attach_info(), pipe=default_pipe).send()
         #parent.close()
 
-    def stop(self, default_pipe):
+    def attach_info(self):
+        return (self.pipe_device_to_logic, self.pipe_logic_to_device)
+
+    def stop(self, default_pipe=None):
         print("dev {} call stop".format(self.phy.instance_id))
-        BusMessage(Message.MSG_BUS_FOUND, self.id(), Token(self.cmd_seq),
-                value=None, pipe=default_pipe).send()
+        if default_pipe:
+            BusMessage(Message.MSG_BUS_FOUND, self.id(), Token(self.cmd_seq),
+                    value=None, pipe=default_pipe).send()
         #self.pipe_device_to_logic.close()
         #self.p.join()
         ThreadServer.unregister(self.__class__.__name__, self.process)
+        if self.own_timer:
+            self.timer.close()
 
         print("stop exit")
 
@@ -54,6 +69,14 @@ class PhyDevice(object):
     def phy_pipe(self):
         return self.pipe_logic_to_device
 
+    def wakeup(self):
+        "schedule process() to run as soon as possible, could be called from the hardware thread"
+        ThreadServer.wakeup(self.__class__.__name__, self.process)
+
+    def poll_interval(self):
+        # seconds to next process() calling, None will wait until message arrived or wakeup()
+        return None
+
     def logic_pipe(self):
         return self.pipe_device_to_logic
 
@@ -63,9 +86,126 @@ class PhyDevice(object):
         #print("process<{}> run".format(self.__class__.__name__))
         pass
 
+def device_process(bus_class, physical, to_device, to_logic):
+    "Entry of the device process, run the PhyDevice with its own ThreadServer until the channel closed"
+    dev = bus_class().create_new_device(physical)
+    MessageServer.attach('phy_to_logic:' + dev.id(), ShmPipe('phy_to_logic:' + dev.id(), to_logic))
+    pump = to_device.pump(MessageServer.open('logic_to_phy:' + dev.id()))
+
+    dev.start()     # attach is reported by the bus in parent
+    while not to_device.closed():
+        ThreadServer.process()
+        ThreadServer.wait()
+
+    dev.stop()
+    pump.join()
+    to_device.release()
+    to_logic.release()
+
+class ProcessDevice(object):
+    """Proxy of the PhyDevice running in an individual process, the messages are transfered
+       through shared memory ring, the physical object should be picklable before opened"""
+    STOP_TIMEOUT = 2 #second
+
+    def __init__(self, bus, physical):
+        self.phy = physical
+        context = multiprocessing.get_context('spawn')
+        self.to_device = ShmChannel(context)
+        self.to_logic = ShmChannel(context)
+        self.pipe_device_to_logic = None
+        self.pipe_logic_to_device = None
+        self.cmd_seq = 0
+        self.pump = None
+        self.p = context.Process(target=device_process,
+                                 args=(bus.__class__, physical, self.to_device, self.to_logic))
+        self.p.daemon = True
+
+    def start(self, default_pipe=None):
+        self.pipe_device_to_logic = MessageServer.open('phy_to_logic:' + self.id())
+        self.pipe_logic_to_device = ShmPipe('logic_to_phy:' + self.id(), self.to_device)
+        self.pump = self.to_logic.pump(self.pipe_device_to_logic)
+        self.p.start()
+
+        if default_pipe:
+            BusMessage(Message.MSG_BUS_FOUND, self.id(), Token(self.cmd_seq),
+                    value=self.attach_info(), pipe=default_pipe).send()
+
+    def attach_info(self):
+        return (self.pipe_device_to_logic, self.pipe_logic_to_device)
+
+    def stop(self, default_pipe=None):
+        print("dev {} process call stop".format(self.phy.instance_id))
+        if default_pipe:
+            BusMessage(Message.MSG_BUS_FOUND, self.id(), Token(self.cmd_seq),
+                    value=None, pipe=default_pipe).send()
+
+        self.to_device.close()
+        self.p.join(self.STOP_TIMEOUT)
+        if self.p.is_alive():
+            print("dev {} process not exit, terminate".format(self.phy.instance_id))
+            self.p.terminate()
+            self.p.join()
+
+        self.to_logic.close()
+        self.pump.join()
+        self.to_device.release()
+        self.to_logic.release()
+        print("stop exit")
+
+    def id(self):
+        if not self.phy:
+            raise BusError("Dev not exist")
+
+        return self.phy.instance_id
+
 class Bus(object):
     def __init__(self):
         self.devices = {}
+        self.multi_process = False  # each device running in individual process
+        self.timer = DeadlineTimer()    # shared by devices on this bus
+        self.hotplug = None
+        self.changed = True # device arrived or removed since last refresh
+        self.changed_lock = threading.Lock()    # set by hotplug thread, taken by BusManager
+
+    def hotplug_source(self):
+        "source of device arrival/removal notification, None if the bus should be polled"
+        return None
+
+    def set_hotplug(self, source):
+        "replace the default hotplug source before BusManager started, e.g. SimulatedHotplug for test"
+        self.hotplug = source
+
+    def start_hotplug(self, notify):
+        "notify() is called when the bus need refresh, return False if no hotplug source (or failed to start)"
+        if self.hotplug is None:
+            self.hotplug = self.hotplug_source()
+
+        if not self.hotplug:
+            return False
+
+        def on_change():
+            with self.changed_lock:
+                self.changed = True
+            notify()
+
+        try:
+            self.hotplug.start(on_change)
+        except OSError as e:    # e.g. no netlink permission in container, poll the bus instead
+            print(self.__class__.__name__, "hotplug start failed:", e)
+            self.hotplug.stop()
+            self.hotplug = False
+            return False
+        return True
+
+    def stop_hotplug(self):
+        if self.hotplug:
+            self.hotplug.stop()
+
+    def need_refresh(self):
+        "take the changed flag, always True for polled bus"
+        with self.changed_lock:     # the change notified after taken is kept for next time
+            changed, self.changed = self.changed, False
+        return changed or not self.hotplug
 
     @abstractmethod
     def create_new_device(self, *args, **kwargs):
@@ -77,23 +217,37 @@ class Bus(object):
         #  return class Device() list object
         pass
 
-    def add_or_remove_phy_devices(self, phys, bus_to_server_pipe):
+    def device_key(self, phy):
+        "stable identity of the device (see Transport.device_key()), a device re-plugged to other port is created again"
+        return phy.device_key()
 
+    def add_or_remove_phy_devices(self, phys, bus_to_server_pipe):
+        "diff the enumerated phys with the known devices, report the changes in one MSG_BUS_CHANGED"
         #print("add_or_remove_phy_devices++")
-        #remove unexist device first
-        for id, dev in self.devices.copy().items():
-            if dev.id() not in map(lambda phy: phy.instance_id, phys):
-                dev.stop(bus_to_server_pipe)
-                del self.devices[id]
-                del dev
+        found = OrderedDict((self.device_key(phy), phy) for phy in phys)
+        events = []
+
+        #remove unexist device first, and the device re-plugged between two refresh (node changed)
+        for key in [key for key, dev in self.devices.items()
+                    if key not in found or found[key].instance_id != dev.id()]:
+            dev = self.devices.pop(key)
+            dev.stop()
+            events.append((key, dev.id(), None))
 
         #add new device
-        for phy in phys:
-            if phy.instance_id not in self.devices.keys():
-                new_dev = self.create_new_device(phy)
-                new_dev.start(bus_to_server_pipe)
-                self.devices[new_dev.id()] = new_dev
+        for key, phy in found.items():
+            if key not in self.devices:
+                if self.multi_process:
+                    new_dev = ProcessDevice(self, phy)
+                else:
+                    new_dev = self.create_new_device(phy)
+                new_dev.start()
+                self.devices[key] = new_dev
+                events.append((key, new_dev.id(), new_dev.attach_info()))
 
+        if events:
+            BusMessage(Message.MSG_BUS_CHANGED, self.__class__.__name__, Message.seq_root(),
+                       value=events, pipe=bus_to_server_pipe).send()
         #print("add_or_remove_phy_devices--")
 
 class BusManager(object):
@@ -102,12 +256,31 @@ class BusManager(object):
     BUS_TABLE = []
     BUS_REFRESH_TIME = 2 #second
 
-    def __init__(self):
-        "bus_to_server_pipe as a default pipe which communicate with the server"
+    def __init__(self, multi_process=False):
+        """bus_to_server_pipe as a default pipe which communicate with the server
+           multi_process: each device will run in an individual process"""
         pipe = MessageServer.open('bus_to_server')
         self.refresh = BusManager.BUS_REFRESH_TIME
+        self.polling = False
+        for bus in self.BUS_TABLE:
+            bus.multi_process = multi_process
+            if not bus.start_hotplug(self.wakeup):
+                self.polling = True     # at least one bus has no hotplug notification
         ThreadServer.register(self.__class__.__name__, self.process, (pipe, ),
-                              ThreadServer.PRIORITY_DEFAULT, self.refresh)
+                              ThreadServer.PRIORITY_DEFAULT, self.poll_interval)
+        self.wakeup()   # first enumeration
+
+    def poll_interval(self):
+        # None: only enumerate when hotplug source notified
+        return self.refresh if self.polling else None
+
+    def wakeup(self):
+        ThreadServer.wakeup(self.__class__.__name__, self.process)
+
+    def stop(self):
+        for bus in self.BUS_TABLE:
+            bus.stop_hotplug()
+        ThreadServer.unregister(self.__class__.__name__, self.process)
 
     def process(self, pipe):
         "watch new devices, if found, create a Device() and send the communication pipe to up level"
@@ -115,8 +288,9 @@ class BusManager(object):
         #print("process<{}> run".format(self.__class__.__name__))
         if len(self.BUS_TABLE) > 0:
             for bus in self.BUS_TABLE:
-                phys = bus.refresh()    #TODO: use RegisterDeviceNotification to watch device change
-                bus.add_or_remove_phy_devices(phys, pipe)
+                if bus.need_refresh():
+                    phys = bus.refresh()
+                    bus.add_or_remove_phy_devices(phys, pipe)
 
             #time.sleep(self.refresh)
 
@@ -8,6 +8,7 @@ are available in the top level hid package
 from __future__ import absolute_import
 from __future__ import print_function
 
+import re
 import sys
 import ctypes
 import threading
@@ -64,6 +65,27 @@ def get_short_usage_id(full_usage_id):
     """Extract 16 bits usage id from full usage id (32 bits)"""
     return full_usage_id & 0xffff
 
+def copy_raw_data(target, data):
+    """Copy report data into c_ubyte array storage, bytes-like data (bytes,
+    bytearray, array('B'), memoryview, ctypes array) is copied by one memcpy
+    """
+    size = len(data)
+    try:
+        source = memoryview(data).cast('B')
+    except TypeError:
+        # not a buffer (list, ReadOnlyList...), slice assignment loops in C
+        target[:size] = data
+    else:
+        memoryview(target).cast('B')[:size] = source
+
+def to_c_ubyte_array(data):
+    "New c_ubyte array from report data, unless it's a c_ubyte array already"
+    if isinstance(data, ctypes.Array) and issubclass(data._type_, c_ubyte):
+        return data
+    raw_data = (c_ubyte * len(data))()
+    copy_raw_data(raw_data, data)
+    return raw_data
+
 def hid_device_path_exists(device_path, guid = None):
     """Test if required device_path is still valid
     (HID device connected to host)
@@ -85,8 +107,40 @@ def hid_device_path_exists(device_path, guid = None):
     # Not any device now with that path
     return False
 
-def find_all_hid_devices():
-    "Finds all HID devices connected to the system"
+# vendor and product id in device path or instance id, i.e.
+# usb: \\?\hid#vid_03eb&pid_6123&mi_01#...
+# bluetooth: \\?\hid#{00001124-...}_vid&0002046d_pid&b012#...
+VID_PID_PATTERN = re.compile(
+        r"vid[_&](?:[0-9a-f]{4})?([0-9a-f]{4})[_&]pid[_&]([0-9a-f]{4})",
+        re.IGNORECASE)
+
+def parse_vid_pid(device_path):
+    """Vendor and product id parsed from device path (or instance id)
+    without opening the device, (None, None) if unknown format
+    """
+    match = VID_PID_PATTERN.search(device_path)
+    if not match:
+        return None, None
+    return int(match.group(1), 16), int(match.group(2), 16)
+
+def vid_pid_path_filter(vendor_id = None, product_id = None):
+    """Device path filter for find_all_hid_devices(), device path
+    which vid/pid couldn't be parsed is accepted (checked after opened)
+    """
+    def path_filter(device_path):
+        vid, pid = parse_vid_pid(device_path)
+        if vid is None:
+            return True
+        if vendor_id is not None and vid != vendor_id:
+            return False
+        if product_id is not None and pid != product_id:
+            return False
+        return True
+    return path_filter
+
+def find_all_hid_devices(path_filter = None):
+    """Finds all HID devices connected to the system, path_filter(device_path)
+    returns False to skip the device before opening it"""
     #
     # From DDK documentation (finding and Opening HID collection):
     # After a user-mode application is loaded, it does the following sequence
@@ -120,11 +174,15 @@ def find_all_hid_devices():
     info_data         = winapi.SP_DEVINFO_DATA()
     info_data.cb_size = sizeof(winapi.SP_DEVINFO_DATA)
 
+    found_paths = set()
     with winapi.DeviceInterfaceSetInfo(guid) as h_info:
         for interface_data in winapi.enum_device_interfaces(h_info, guid):
             device_path = winapi.get_device_path(h_info,
                     interface_data,
                     byref(info_data))
+            found_paths.add(device_path)
+            if path_filter and not path_filter(device_path):
+                continue
 
             parent_device = c_ulong()
 
@@ -153,6 +211,9 @@ def find_all_hid_devices():
             # add device to results, if not protected
             if hid_device.vendor_id:
                 results.append(hid_device)
+
+    # removed devices
+    HidDevice.invalidate_attributes(HidDevice.cached_paths() - found_paths)
     return results
 
 class HidDeviceFilter(object):
@@ -165,6 +226,20 @@ class HidDeviceFilter(object):
         """
         self.filter_params = kwrds
 
+    def path_filter(self):
+        """Device path filter from plain vendor_id/product_id parameters,
+        None if no such parameter
+        """
+        params = dict()
+        for item in ("vendor_id", "product_id"):
+            if item in self.filter_params and not (item + "_mask" in \
+                    self.filter_params or item + "_includes" in \
+                    self.filter_params):
+                params[item] = self.filter_params[item]
+        if not params:
+            return None
+        return vid_pid_path_filter(**params)
+
     def get_devices_by_parent(self, hid_filter=None):
         """Group devices returned from filter query in order \
         by devcice parent id.
@@ -187,8 +262,9 @@ class HidDeviceFilter(object):
         """
         if not hid_filter: #empty list or called without any parameters
             if type(hid_filter) == type(None):
-                #request to query connected devices
-                hid_filter = find_all_hid_devices()
+                #request to query connected devices, vid/pid is filtered
+                #by device path before opening
+                hid_filter = find_all_hid_devices(self.path_filter())
             else:
                 return hid_filter
         #initially all accepted
@@ -259,6 +335,31 @@ class HidDevice(HidDeviceBaseClass):
     filter_attributes = ["vendor_id", "product_id", "version_number",
         "product_name", "vendor_name"]
 
+    # attributes read from the device, cached by device path so enumeration
+    # doesn't open the known devices again
+    cached_attributes = ["vendor_id", "product_id", "version_number",
+        "product_name", "vendor_name", "serial_number"]
+    __attributes_cache = dict()
+    __attributes_lock  = threading.Lock()
+
+    @classmethod
+    def cached_paths(cls):
+        """Device paths with cached attributes"""
+        with cls.__attributes_lock:
+            return set(cls.__attributes_cache.keys())
+
+    @classmethod
+    def invalidate_attributes(cls, device_paths = None):
+        """Drop cached attributes of device paths (removed devices),
+        all if device_paths is None
+        """
+        with cls.__attributes_lock:
+            if device_paths is None:
+                cls.__attributes_cache.clear()
+            else:
+                for device_path in device_paths:
+                    cls.__attributes_cache.pop(device_path, None)
+
     def get_parent_instance_id(self):
         """Retreive system instance id (numerical value)"""
         return self.parent_instance_id
@@ -291,6 +392,9 @@ class HidDevice(HidDeviceBaseClass):
         self.__reading_thread          = None
         self.__input_processing_thread = None
         self.__raw_handler             = None
+        self.__raw_batch_handler       = None
+        self.__raw_data_wrapper        = helpers.ReadOnlyList
+        self.__raw_batch_wrapper       = helpers.ReadOnlyList
         self._input_report_queue       = None
         self.hid_caps                  = None
         self.ptr_preparsed_data        = None
@@ -308,6 +412,12 @@ class HidDevice(HidDeviceBaseClass):
         self.version_number     = 0
         HidDeviceBaseClass.__init__(self)
 
+        with self.__attributes_lock:
+            cached = self.__attributes_cache.get(device_path)
+        if cached:
+            self.__dict__.update(cached)
+            return
+
         # HID device handle first
         h_hid = INVALID_HANDLE_VALUE
         try:
@@ -382,6 +492,10 @@ class HidDevice(HidDeviceBaseClass):
                 self.serial_number = serial_number.value
             del serial_number
             del serial_number_string
+
+            with self.__attributes_lock:
+                self.__attributes_cache[device_path] = dict((name,
+                        getattr(self, name)) for name in self.cached_attributes)
         finally:
             # clean up
             winapi.CloseHandle(h_hid)
@@ -500,7 +614,8 @@ class HidDevice(HidDeviceBaseClass):
             #prepare input reports handlers
             self._input_report_queue = HidDevice.InputReportQueue( \
                     self.max_input_queue_size,
-                    self.hid_caps.input_report_byte_length)
+                    self.hid_caps.input_report_byte_length,
+                    self.input_queue_overflow)
             self.__input_processing_thread = \
                     HidDevice.InputReportProcessingThread(self)
             self.__reading_thread = HidDevice.InputReportReaderThread( \
@@ -523,14 +638,7 @@ class HidDevice(HidDeviceBaseClass):
         """
         assert( self.is_opened() )
         #make sure we have c_ubyte array storage
-        if not ( isinstance(data, ctypes.Array) and \
-                issubclass(data._type_, c_ubyte) ):
-            raw_data_type = c_ubyte * len(data)
-            raw_data = raw_data_type()
-            for index in range( len(data) ):
-                raw_data[index] = data[index]
-        else:
-            raw_data = data
+        raw_data = to_c_ubyte_array(data)
         #
         # Adding a lock when writing (overlapped writes)
         over_write = winapi.OVERLAPPED()
@@ -572,14 +680,7 @@ class HidDevice(HidDeviceBaseClass):
         """
         assert( self.is_opened() )
         #make sure we have c_ubyte array storage
-        if not ( isinstance(data, ctypes.Array) and issubclass(data._type_,
-                c_ubyte) ):
-            raw_data_type = c_ubyte * len(data)
-            raw_data = raw_data_type()
-            for index in range( len(data) ):
-                raw_data[index] = data[index]
-        else:
-            raw_data = data
+        raw_data = to_c_ubyte_array(data)
 
         return hid_dll.HidD_SetFeature(int(self.hid_handle), byref(raw_data),
                 len(raw_data))
@@ -702,6 +803,7 @@ class HidDevice(HidDeviceBaseClass):
         return dict([(t, r) for t, r in items if r])
 
     max_input_queue_size = 20
+    input_queue_overflow = "drop_oldest" # InputReportQueue overflow policy
     evt_decision = {
         #a=old_value, b=new_value
         HID_EVT_NONE:       lambda a,b: False,
@@ -716,11 +818,27 @@ class HidDevice(HidDeviceBaseClass):
     @helpers.synchronized(HidDeviceBaseClass._raw_reports_lock)
     def _process_raw_report(self, raw_report):
         "Default raw input report data handler"
-        if not self.is_opened():
-            return
-        if not self.__evt_handlers and not self.__raw_handler:
+        self.__process_raw_report(raw_report)
+
+    @helpers.synchronized(HidDeviceBaseClass._raw_reports_lock)
+    def _process_raw_reports(self, raw_reports):
+        """Raw input reports handler of a batch, the lock is taken once,
+        the batch handler (if set) is called once with all the reports"""
+        if self.__raw_batch_handler:
+            if not self.is_opened():
+                return
+            wrapper = self.__raw_batch_wrapper
+            batch = [wrapper(raw_report) for raw_report in raw_reports \
+                    if self.__valid_report(raw_report)]
+            if batch:
+                self.__raw_batch_handler(batch)
             return
 
+        for raw_report in raw_reports:
+            self.__process_raw_report(raw_report)
+
+    def __valid_report(self, raw_report):
+        "False for the empty report sent by windows when disconnecting"
         if not raw_report[0]  and \
                 (raw_report[0] not in self.__input_report_templates):
             # windows sends an empty array when disconnecting
@@ -728,11 +846,22 @@ class HidDevice(HidDeviceBaseClass):
             if not hid_device_path_exists(self.device_path):
                 #windows XP sends empty report when disconnecting
                 self.__reading_thread.abort() #device disconnected
+            return False
+        return True
+
+    def __process_raw_report(self, raw_report):
+        "Raw input report handler, called with the reports lock held"
+        if not self.is_opened():
+            return
+        if not self.__evt_handlers and not self.__raw_handler:
+            return
+
+        if not self.__valid_report(raw_report):
             return
 
         if self.__raw_handler:
             #this might slow down data throughput, but at the expense of safety
-            self.__raw_handler(helpers.ReadOnlyList(raw_report))
+            self.__raw_handler(self.__raw_data_wrapper(raw_report))
             return
 
         # using pre-parsed report templates, by report id
@@ -762,9 +891,23 @@ class HidDevice(HidDeviceBaseClass):
                     else:
                         function_handler(new_value, event_kind)
 
-    def set_raw_data_handler(self, funct):
-        "Set external raw data handler, set to None to restore default"
+    def set_raw_data_handler(self, funct, as_memoryview = False):
+        """Set external raw data handler, set to None to restore default.
+        as_memoryview: the handler gets a read only memoryview over the
+        pooled report buffer instead of a list copy, it's only valid until
+        the handler returns, use bytes(view) to keep the data"""
         self.__raw_handler = funct
+        self.__raw_data_wrapper = helpers.read_only_view if as_memoryview \
+                else helpers.ReadOnlyList
+
+    def set_raw_data_batch_handler(self, funct, as_memoryview = False):
+        """Set external handler of the raw data list, called once for all
+        the reports queued since last call. It takes precedence over the raw
+        data handler, set to None to restore.
+        as_memoryview: same as set_raw_data_handler()"""
+        self.__raw_batch_handler = funct
+        self.__raw_batch_wrapper = helpers.read_only_view if as_memoryview \
+                else helpers.ReadOnlyList
 
     def find_input_usage(self, full_usage_id):
         """Check if full usage Id included in input reports set
@@ -804,46 +947,82 @@ class HidDevice(HidDeviceBaseClass):
         return True
 
     class InputReportQueue(object):
-        """Multi-threaded queue. Allows to queue reports from reading thread"""
-        def __init__(self, max_size, report_size):
+        """Single producer (reading thread) / single consumer (processing
+        thread) queue of preallocated report buffers.
+        deque append()/popleft() are atomic, so no lock is taken per report,
+        the consumer is only woken up when it's waiting for data.
+        When all the buffers are posted, overflow policy applies:
+            DROP_OLDEST     oldest posted report is overwritten
+            DROP_NEWEST     new report is read into a spare buffer and dropped
+            BLOCK           reading thread waits until a buffer is reused
+        When no buffer is posted, all of them are held by the consumer,
+        nothing could be dropped, so every policy waits until a buffer is
+        reused (the reports stay in the device until then)
+        """
+        (DROP_OLDEST, DROP_NEWEST, BLOCK) = ("drop_oldest", "drop_newest",
+                "block")
+        BLOCK_POLL = 0.5 #second, blocked producer checks release_events()
+
+        def __init__(self, max_size, report_size, overflow = DROP_OLDEST):
+            if overflow not in (self.DROP_OLDEST, self.DROP_NEWEST,
+                    self.BLOCK):
+                raise HIDError("Unknown input queue overflow policy: %s" \
+                        % overflow)
             self.__locked_down = False
             self.max_size = max_size
+            self.overflow = overflow
             self.repport_buffer_type = c_ubyte * report_size
-            self.used_queue = []
-            self.fresh_queue = []
-            self.used_lock = threading.Lock()
-            self.fresh_lock = threading.Lock()
+            # one more buffer for the reading thread, so max_size reports
+            # could be posted
+            self.used_queue = collections.deque(self.repport_buffer_type() \
+                    for _ in range(max(max_size, 1) + 1))
+            self.fresh_queue = collections.deque()
+            self.spare_report = self.repport_buffer_type()
+            self.dropped = 0
             self.posted_event = threading.Event()
+            self.reused_event = threading.Event()
 
         #@logging_decorator
         def get_new(self):
-            "Allocates storage for input report"
-            if self.__locked_down:
-                return None
-            self.used_lock.acquire()
-            if len(self.used_queue):
-                #we can reuse items
-                empty_report = self.used_queue.pop(0)
-                self.used_lock.release()
+            "Get storage for input report, None if released"
+            while not self.__locked_down:
+                try:
+                    empty_report = self.used_queue.popleft()
+                except IndexError:
+                    empty_report = self.__overflow()
+                    if empty_report is None:
+                        continue
                 ctypes.memset(empty_report, 0, sizeof(empty_report))
-            else:
-                self.used_lock.release()
-                #create brand new storage
-                #auto initialized to '0' by ctypes
-                empty_report = self.repport_buffer_type()
-            return empty_report
+                return empty_report
+            return None
+
+        def __overflow(self):
+            """No buffer is free, return the storage by policy, None after
+            waited for a buffer reused"""
+            if self.fresh_queue:
+                if self.overflow == self.DROP_OLDEST:
+                    try:
+                        # the consumer may take it at the same time
+                        oldest_report = self.fresh_queue.popleft()
+                    except IndexError:
+                        return None
+                    self.dropped += 1
+                    return oldest_report
+                elif self.overflow == self.DROP_NEWEST:
+                    return self.spare_report
+            # blocked, or all the buffers are held by the consumer
+            self.reused_event.clear()
+            if not self.used_queue: # reused before clear()
+                self.reused_event.wait(self.BLOCK_POLL)
+            return None
 
         def reuse(self, raw_report):
-            "Reuse not posted report"
-            if self.__locked_down:
-                return
-            if not raw_report:
+            "Give back the report storage"
+            if not raw_report or raw_report is self.spare_report:
                 return
-            self.used_lock.acquire()
-            #we can reuse this item
             self.used_queue.append(raw_report)
-            self.used_lock.release()
-
+            if not self.reused_event.is_set():
+                self.reused_event.set()
 
         #@logging_decorator
         def post(self, raw_report):
@@ -851,36 +1030,55 @@ class HidDevice(HidDeviceBaseClass):
             if self.__locked_down:
                 self.posted_event.set()
                 return
-            self.fresh_lock.acquire()
-            self.fresh_queue.append( raw_report )
-            self.posted_event.set()
-            self.fresh_lock.release()
+            if raw_report is self.spare_report:
+                self.dropped += 1
+                return
+            self.fresh_queue.append(raw_report)
+            # wake up the consumer only if it's waiting
+            if not self.posted_event.is_set():
+                self.posted_event.set()
+
+        def __wait(self):
+            "Wait until there is data, False if released"
+            while not self.__locked_down:
+                if self.fresh_queue:
+                    return True
+                self.posted_event.clear()
+                if self.fresh_queue: # posted before clear()
+                    return True
+                self.posted_event.wait()
+            return False
 
         #@logging_decorator
         def get(self):
             """Used to retreive one report form the queue"""
-            if self.__locked_down:
-                return None
-
-            #wait for data
-            self.posted_event.wait()
-            self.fresh_lock.acquire()
-
-            if self.__locked_down:
-                self.fresh_lock.release()
-                return None
-
-            item = self.fresh_queue.pop(0)
-            if not self.fresh_queue:
-                # emtpy
-                self.posted_event.clear()
-            self.fresh_lock.release()
-            return item
+            while self.__wait():
+                try:
+                    return self.fresh_queue.popleft()
+                except IndexError: # dropped by the producer
+                    continue
+            return None
+
+        def get_all(self):
+            """Used to retreive the posted reports, waits for the first
+            one, empty list if released. At most max_size - 1 reports each
+            batch, so a buffer is left for the reading thread"""
+            batch = []
+            fresh_queue = self.fresh_queue
+            batch_max = max(self.max_size - 1, 1)
+            while not batch and self.__wait():
+                try:
+                    while len(batch) < batch_max:
+                        batch.append(fresh_queue.popleft())
+                except IndexError:
+                    pass
+            return batch
 
         def release_events(self):
             """Release thread locks."""
             self.__locked_down = True
             self.posted_event.set()
+            self.reused_event.set()
 
     class InputReportProcessingThread(threading.Thread):
         "Input reports handler helper class"
@@ -901,12 +1099,13 @@ class HidDevice(HidDeviceBaseClass):
             hid_object = self.hid_object
             report_queue = hid_object._input_report_queue
             while not self.__abort and hid_object.is_opened():
-                raw_report = report_queue.get()
-                if not raw_report or self.__abort:
+                raw_reports = report_queue.get_all()
+                if not raw_reports or self.__abort:
                     break
-                hid_object._process_raw_report(raw_report)
-                # reuse the report (avoid allocating new memory)
-                report_queue.reuse(raw_report)
+                hid_object._process_raw_reports(raw_reports)
+                # reuse the reports (avoid allocating new memory)
+                for raw_report in raw_reports:
+                    report_queue.reuse(raw_report)
 
     class InputReportReaderThread(threading.Thread):
         "Helper to receive input reports"
@@ -1305,15 +1504,15 @@ class HidReport(object):
         if self.__raw_data == None: #first time only, create storage
             raw_data_type = c_ubyte * self.__raw_report_size
             self.__raw_data = raw_data_type()
-        elif initial_values == self.__raw_data:
+        elif initial_values is self.__raw_data:
             # already
             return
-        else:
+        elif initial_values is None or \
+                len(initial_values) < len(self.__raw_data):
             #initialize
             ctypes.memset(self.__raw_data, 0, len(self.__raw_data))
-        if initial_values:
-            for index in range(len(initial_values)):
-                self.__raw_data[index] = initial_values[index]
+        if initial_values is not None and len(initial_values):
+            copy_raw_data(self.__raw_data, initial_values)
 
     def set_raw_data(self, raw_data):
         """Set usage values based on given raw data, item[0] is report_id,
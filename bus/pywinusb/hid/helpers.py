@@ -70,6 +70,11 @@ def synchronized(lock):
         return new_function
     return wrap
 
+def read_only_view(raw_buffer):
+    """Read only memoryview of bytes over the buffer (no copy), it's only
+    valid while the buffer is not reused"""
+    return memoryview(raw_buffer).cast('B').toreadonly()
+
 class ReadOnlyList(UserList):
     "Read only sequence wrapper"
     def __init__(self, any_list):
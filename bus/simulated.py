@@ -0,0 +1,297 @@
+"""
+Simulated HID bridge with a maXTouch device behind it, to run Hid_Device/LogicDevice/TestKits without hardware
+
+The bridge protocol (report data after the report id byte):
+    Test:           0x80 0 value                    -> 0x80 0 value
+    Read Register:  0x51 2 LenR AddrL AddrH         -> RW_OK LenR data...
+    Write Register: 0x51 LenW LenR=0 AddrL AddrH data... -> W_ONLY_OK LenW-2
+    IRQ:            0x88 0x58 2 size AddrL AddrH    -> 0x88 OK, then the bridge reads size bytes at Addr
+                                                       (T5) on each CHG and reports 0x9A RW_OK data...
+    Others:         cmd ...                         -> cmd OK
+
+Responses are delayed by latency +- jitter (in sending order, as the bridge does), and dropped by loss rate.
+The random source is seeded, so a test run is repeatable.
+"""
+import random
+import struct
+import threading
+import time
+from collections import deque
+
+from bus.hotplug import SimulatedHotplug
+from bus.manage import Bus
+from bus.hid_bus import Hid_Device
+from bus.transport import Transport
+from server.devinfo import crc24
+
+class MxtMemory(object):
+    "maXTouch memory map: ID information, object table, info crc, then the objects"
+    ID_SIZE = 7
+    ELEMENT = struct.Struct('<BHBBB')   # type start_address size-1 instances-1 report_ids
+    CRC_SIZE = 3
+
+    (GEN_MESSAGE_T5, GEN_COMMAND_T6, DEBUG_DIAGNOSTIC_T37, SPT_MESSAGECOUNT_T44) = (5, 6, 37, 44)
+    (T6_RESET, T6_BACKUPNV, T6_CALIBRATE, T6_REPORTALL, T6_DIAGNOSTIC) = (0, 1, 2, 3, 5)
+    T6_STATUS_RESET = 0x80
+    NO_MESSAGE = 0xFF
+
+    # (type, size, instances, report ids each instance)
+    OBJECTS = ((37, 130, 1, 0), (44, 1, 1, 0), (5, 10, 1, 0), (6, 6, 1, 1), (38, 8, 1, 0),
+               (7, 4, 1, 0), (8, 15, 1, 0), (15, 11, 2, 1), (18, 2, 1, 0), (19, 6, 1, 1),
+               (25, 21, 1, 1), (100, 60, 1, 12))
+    ID_INFORMATION = (0xA6, 0x15, 0x10, 0xAA, 32, 20)   # family variant version build xsize ysize
+
+    def __init__(self, objects=OBJECTS, id_information=ID_INFORMATION):
+        table_end = self.ID_SIZE + self.ELEMENT.size * len(objects)
+        self.objects = {}   # type: (start address, size, instances, first report id)
+        self.report_ids = {}    # report id: (type, instance)
+        table = bytearray()
+        addr = table_end + self.CRC_SIZE
+        report_id = 1
+        for type, size, instances, num_report_ids in objects:
+            table += self.ELEMENT.pack(type, addr, size - 1, instances - 1, num_report_ids)
+            self.objects[type] = (addr, size, instances, report_id if num_report_ids else 0)
+            for i in range(instances * num_report_ids):
+                self.report_ids[report_id] = (type, i // num_report_ids)
+                report_id += 1
+            addr += size * instances
+
+        self.mem = bytearray(addr)
+        self.mem[:self.ID_SIZE] = bytes(id_information) + bytes([len(objects)])
+        self.mem[self.ID_SIZE: table_end] = table
+        self.mem[table_end: table_end + self.CRC_SIZE] = crc24(self.mem[:table_end]).to_bytes(3, 'little')
+
+        self.messages = deque()    # T5 message queue
+        self.lock = threading.Lock()
+        self.load_message()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def size(self):
+        return len(self.mem)
+
+    def object_address(self, type, instance=0):
+        addr, size, instances, report_id = self.objects[type]
+        return addr + size * instance
+
+    def object_report_id(self, type, instance=0):
+        addr, size, instances, report_id = self.objects[type]
+        return report_id
+
+    def read(self, addr, size):
+        "None if out of range, reading T5 pops the message as the chip does"
+        if addr + size > len(self.mem):
+            return None
+
+        with self.lock:
+            data = bytes(self.mem[addr: addr + size])
+            if self.GEN_MESSAGE_T5 in self.objects and addr == self.object_address(self.GEN_MESSAGE_T5):
+                if self.messages:
+                    self.messages.popleft()
+                self.load_message()
+        return data
+
+    def write(self, addr, data):
+        "return the size written, 0 if out of range"
+        if addr + len(data) > len(self.mem):
+            return 0
+
+        with self.lock:
+            self.mem[addr: addr + len(data)] = data
+        if self.GEN_COMMAND_T6 in self.objects:
+            t6 = self.object_address(self.GEN_COMMAND_T6)
+            if addr <= t6 + self.T6_DIAGNOSTIC and addr + len(data) > t6:
+                self.command(t6)
+        return len(data)
+
+    def post_message(self, report_id, payload):
+        "queue a message to T5, return True if it's the only one (CHG asserted now)"
+        with self.lock:
+            self.messages.append(bytes([report_id]) + bytes(payload))
+            self.load_message()
+            return len(self.messages) == 1
+
+    def pending(self):
+        return len(self.messages)
+
+    def load_message(self):
+        "show the first message in T5 and the count in T44"
+        if self.GEN_MESSAGE_T5 in self.objects:
+            addr, size, instances, report_id = self.objects[self.GEN_MESSAGE_T5]
+            message = self.messages[0][:size] if self.messages else bytes([self.NO_MESSAGE])
+            self.mem[addr: addr + size] = message + bytes(size - len(message))
+        if self.SPT_MESSAGECOUNT_T44 in self.objects:
+            self.mem[self.object_address(self.SPT_MESSAGECOUNT_T44)] = min(len(self.messages), 0xFF)
+
+    def command(self, t6):
+        "T6 command processor, the command byte is cleared when done"
+        mem = self.mem
+        for field in (self.T6_RESET, self.T6_BACKUPNV, self.T6_CALIBRATE, self.T6_REPORTALL):
+            if mem[t6 + field]:
+                mem[t6 + field] = 0
+                status = self.T6_STATUS_RESET if field == self.T6_RESET else 0
+                self.post_message(self.object_report_id(self.GEN_COMMAND_T6), [status, 0, 0, 0, 0])
+
+        mode = mem[t6 + self.T6_DIAGNOSTIC]
+        if mode and self.DEBUG_DIAGNOSTIC_T37 in self.objects:
+            mem[t6 + self.T6_DIAGNOSTIC] = 0
+            t37 = self.object_address(self.DEBUG_DIAGNOSTIC_T37)
+            mem[t37] = mode
+            mem[t37 + 1] = (mem[t37 + 1] + 1) & 0xFF if mode in (0x01, 0x02) else 0    # page up/down
+            size = self.objects[self.DEBUG_DIAGNOSTIC_T37][1]
+            mem[t37 + 2: t37 + size] = bytes((mode + i) & 0xFF for i in range(size - 2))
+
+class SimulatedTransport(Transport):
+    "Bridge with MxtMemory, responses are delivered by the reader thread of Transport"
+    REPORT_SIZE = 64
+    (RW_OK, NAK_W, NAK_ADDR, W_ONLY_OK) = range(4)
+    (OK, FAILED) = range(2)
+    (CMD_TEST, CMD_IRQ, CMD_WRITE_READ, CMD_INTERRUPT) = (0x80, (0x88, 0x58), 0x51, 0x9A)
+
+    def __init__(self, instance_id='SIM', parent_instance_id=None, memory=None,
+                 latency=0.0005, jitter=0, loss=0, seed=0):
+        super(SimulatedTransport, self).__init__(instance_id, parent_instance_id)
+        self.memory = memory if memory else MxtMemory()
+        self.latency = latency  # second
+        self.jitter = jitter    # second, uniform in +-jitter
+        self.loss = loss    # rate of the lost response, 0 ~ 1
+        self.random = random.Random(seed)
+        self.irq = None     # (addr, size) to read on CHG, set by the IRQ command
+        self.responses = deque()    # (due, report) in sending order
+        self.cond = threading.Condition()
+        self.last_due = 0
+        self.stats = dict(write=0, response=0, lost=0, interrupt=0)
+
+    def __getstate__(self):
+        state = super(SimulatedTransport, self).__getstate__()
+        state.update(cond=None, responses=deque())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cond = threading.Condition()
+
+    def close(self):
+        self.opened = False
+        with self.cond:
+            self.cond.notify_all()
+        super(SimulatedTransport, self).close()
+
+    def output_report_size(self):
+        return self.REPORT_SIZE
+
+    def write_report(self, data):
+        if not self.opened:
+            return False
+
+        self.stats['write'] += 1
+        response = self.execute(data[1:])   # skip report id
+        if response is not None:
+            self.respond(response)
+        self.report_messages()  # CHG may be asserted by the command
+        return True
+
+    def execute(self, cmd):
+        "bridge command to response data, None if no response"
+        if cmd[0] == self.CMD_TEST:
+            return [self.CMD_TEST, 0, cmd[2]]
+        elif cmd[0] == self.CMD_WRITE_READ:
+            len_w, len_r = cmd[1], cmd[2]
+            addr = cmd[3] | (cmd[4] << 8)
+            if len_r:
+                data = self.memory.read(addr, len_r)
+                if data is None:
+                    return [self.NAK_ADDR, 0]
+                return [self.RW_OK, len_r] + list(data)
+            else:
+                size = self.memory.write(addr, bytes(cmd[5: 5 + len_w - 2]))
+                if not size and len_w > 2:
+                    return [self.NAK_ADDR, 0]
+                return [self.W_ONLY_OK, size]
+        elif tuple(cmd[:2]) == self.CMD_IRQ:
+            self.irq = (cmd[4] | (cmd[5] << 8), cmd[3])
+            return [cmd[0], self.OK]
+        else:
+            return [cmd[0], self.OK]
+
+    def respond(self, data, lossy=True):
+        "queue the input report, delivered in order after latency +- jitter"
+        if lossy and self.loss and self.random.random() < self.loss:
+            self.stats['lost'] += 1
+            return
+
+        delay = self.latency
+        if self.jitter:
+            delay += self.random.uniform(-self.jitter, self.jitter)
+        with self.cond:
+            due = max(time.time() + max(delay, 0), self.last_due)
+            self.last_due = due
+            report = bytearray(self.REPORT_SIZE + 1)
+            report[1: 1 + len(data)] = bytes(data)
+            self.responses.append((due, report))
+            self.cond.notify()
+
+    def interrupt(self, report_id=None, payload=(0,) * 8):
+        "the chip generates a message (T100 by default), reported as 0x9A if IRQ is set"
+        if report_id is None:
+            report_id = self.memory.object_report_id(100)
+        if self.memory.post_message(report_id, payload):
+            self.report_messages()
+
+    def report_messages(self):
+        "CHG is asserted while T5 has message, the bridge reads all of them"
+        if not self.irq:
+            return
+
+        addr, size = self.irq
+        with self.cond:     # interrupt() and write_report() may come from different threads
+            while self.memory.pending():
+                data = self.memory.read(addr, size)
+                if data is None:
+                    break
+                self.stats['interrupt'] += 1
+                self.respond([self.CMD_INTERRUPT, self.RW_OK] + list(data))
+
+    def read_report(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.opened:
+                now = time.time()
+                if self.responses and self.responses[0][0] <= now:
+                    self.stats['response'] += 1
+                    return self.responses.popleft()[1]
+
+                wait = self.responses[0][0] - now if self.responses else None
+                if deadline is not None:
+                    if now >= deadline:
+                        break
+                    wait = min(wait, deadline - now) if wait is not None else deadline - now
+                self.cond.wait(wait)
+
+class SimulatedBus(Bus):
+    "Bus of SimulatedTransport, devices are attached/detached by the test instead of enumeration"
+    def __init__(self):
+        super(SimulatedBus, self).__init__()
+        self.transports = []
+        self.set_hotplug(SimulatedHotplug())
+
+    def create_new_device(self, *args, **kwargs):
+        return Hid_Device(*args, timer=self.timer, **kwargs)
+
+    def attach(self, transport):
+        self.transports.append(transport)
+        self.hotplug.arrive()
+
+    def detach(self, transport):
+        self.transports.remove(transport)
+        self.hotplug.remove()
+
+    def refresh(self):
+        return list(self.transports)
@@ -0,0 +1,210 @@
+"""
+Transport of the HID bridge under Hid_Device: open, write report, read report with timeout, close
+
+The report data start with the report id byte (0 for the bridge), the same as pywinusb raw data.
+The report passed to the handlers is any bytes-like object, which may be a memoryview of the transport buffer
+that is only valid until the handler returns, so the handler copies what it keeps.
+Input reports are pushed to the raw data handler by a reader thread, or read by read_report() if no handler.
+With a batch handler, the reports arrived together are pushed in one call.
+"""
+from abc import ABCMeta, abstractmethod
+import os
+import selectors
+import threading
+import time
+
+HID_EVT_ALL = 1     # event type of raw data, same value as pywinusb
+
+class Transport(metaclass=ABCMeta):
+    "Base of transport, instance_id/parent_instance_id identify the device on bus"
+    READ_TIMEOUT = 0.5  #second, the reader thread checks close() at least this often
+    BATCH_MAX = 64  #reports to the batch handler each call
+
+    def __init__(self, instance_id, parent_instance_id=None):
+        self.instance_id = instance_id
+        self.parent_instance_id = parent_instance_id
+        self.raw_handler = None
+        self.raw_batch_handler = None
+        self.reader = None
+        self.opened = False
+
+    def __getstate__(self):
+        "picklable before opened, passed to the device process"
+        state = self.__dict__.copy()
+        state.update(reader=None, raw_handler=None, raw_batch_handler=None, opened=False)
+        return state
+
+    def open(self):
+        self.opened = True
+        self.reader = threading.Thread(target=self.read_loop, name='reader:' + str(self.instance_id))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def close(self):
+        self.opened = False
+        if self.reader and self.reader is not threading.current_thread():
+            self.reader.join()
+        self.reader = None
+
+    def is_opened(self):
+        return self.opened
+
+    def device_key(self):
+        "identity of the device on bus, which should not change when the device re-plugged to the same port"
+        return (self.instance_id, self.parent_instance_id)
+
+    def set_raw_data_handler(self, handler):
+        "handler(raw_data) is called in reader thread, None to read by read_report()"
+        self.raw_handler = handler
+
+    def set_raw_batch_handler(self, handler):
+        "handler(list of raw_data) is called in reader thread instead of the raw data handler, None to restore"
+        self.raw_batch_handler = handler
+
+    @abstractmethod
+    def output_report_size(self):
+        "output report data size, without report id"
+
+    @abstractmethod
+    def write_report(self, data):
+        "data start with report id, return True if sent"
+
+    @abstractmethod
+    def read_report(self, timeout=None):
+        "return the input report start with report id, None if timeout"
+
+    def read_loop(self):
+        while self.opened:
+            handler = self.raw_handler
+            batch_handler = self.raw_batch_handler
+            if not handler and not batch_handler:
+                time.sleep(self.READ_TIMEOUT)
+                continue
+
+            batch = None
+            try:
+                data = self.read_report(self.READ_TIMEOUT)
+                if data and batch_handler:
+                    batch = [data]
+                    while len(batch) < self.BATCH_MAX:   # the others arrived already
+                        data = self.read_report(0)
+                        if not data:
+                            break
+                        batch.append(data)
+            except OSError as e:
+                print(self.__class__.__name__, "read failed:", e)
+                break
+
+            if batch_handler:
+                if batch:
+                    batch_handler(batch)
+            elif data:
+                handler(data)
+
+class HidrawTransport(Transport):
+    "Linux /dev/hidraw* node, non-blocking read with selectors, no report parsing needed"
+    REPORT_SIZE = 64    #bridge report size without report id
+
+    def __init__(self, path, instance_id=None, parent_instance_id=None, report_size=REPORT_SIZE, report_id=0,
+                 vendor_id=0, product_id=0, uniq=None):
+        super(HidrawTransport, self).__init__(instance_id if instance_id else path, parent_instance_id)
+        self.path = path
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.uniq = uniq    # HID_UNIQ, serial number if the device has
+        self.report_size = report_size
+        self.report_id = report_id
+        self.fd = None
+        self.selector = None
+
+    def __getstate__(self):
+        state = super(HidrawTransport, self).__getstate__()
+        state.update(fd=None, selector=None)
+        return state
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+        super(HidrawTransport, self).open()
+
+    def close(self):
+        super(HidrawTransport, self).close()
+        if self.fd is not None:
+            self.selector.close()
+            os.close(self.fd)
+            self.fd = self.selector = None
+
+    def device_key(self):
+        "hidraw node and sysfs name are numbered again after re-plugged, the physical path (HID_PHYS) is not"
+        if not self.parent_instance_id:
+            return super(HidrawTransport, self).device_key()
+        return (self.vendor_id, self.product_id, self.parent_instance_id, self.uniq)
+
+    def output_report_size(self):
+        return self.report_size
+
+    def write_report(self, data):
+        return os.write(self.fd, data) == len(data)
+
+    def read_report(self, timeout=None):
+        if not self.selector.select(timeout):
+            return None
+
+        data = bytearray(self.report_size + 1)
+        with memoryview(data) as view:  # released before the data is resized
+            try:
+                if not self.report_id:  # unnumbered report has no report id from hidraw, read after the 0 id
+                    size = os.readv(self.fd, [view[1:]])
+                    if size:
+                        size += 1
+                else:
+                    size = os.readv(self.fd, [view])
+            except BlockingIOError:
+                return None
+
+        if not size:
+            return None
+        del data[size:]
+        return data
+
+SYSFS_HIDRAW = '/sys/class/hidraw'
+
+def read_uevent(path):
+    "KEY=VALUE lines of sysfs uevent to dict"
+    info = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if sep:
+                    info[key] = value
+    except OSError:
+        pass
+    return info
+
+def find_hidraw_devices(vendor_id=0, product_id=0):
+    "hidraw nodes of the vid/pid (0 for any), device is not opened"
+    result = []
+    try:
+        names = sorted(os.listdir(SYSFS_HIDRAW))
+    except OSError:
+        return result
+
+    for name in names:
+        device = os.path.join(SYSFS_HIDRAW, name, 'device')
+        info = read_uevent(os.path.join(device, 'uevent'))
+        try:
+            bus, vid, pid = (int(v, 16) for v in info['HID_ID'].split(':'))
+        except (KeyError, ValueError):
+            continue
+
+        if (vendor_id and vid != vendor_id) or (product_id and pid != product_id):
+            continue
+
+        # instance id changes after re-plugged, the port is the physical path
+        instance_id = os.path.basename(os.path.realpath(device))
+        result.append(HidrawTransport('/dev/' + name, instance_id, info.get('HID_PHYS'),
+                                      vendor_id=vid, product_id=pid, uniq=info.get('HID_UNIQ') or None))
+
+    return result
@@ -0,0 +1,155 @@
+"""
+Windows transport and hotplug of the HID bridge, based on pywinusb
+"""
+import ctypes
+from ctypes import wintypes
+from collections import deque
+from threading import Thread, Event
+
+import bus.pywinusb.hid as usbhid
+from bus.hotplug import HotplugSource
+from bus.transport import Transport
+
+class PyWinUsbTransport(Transport):
+    "pywinusb HidDevice, the reading thread and report parsing are done by pywinusb"
+    USAGE_ID_INPUT = usbhid.get_full_usage_id(0xffff, 0x03)
+    USAGE_ID_OUTPUT = usbhid.get_full_usage_id(0xffff, 0x05)
+
+    def __init__(self, device):
+        super(PyWinUsbTransport, self).__init__(device.instance_id, device.parent_instance_id)
+        self.device = device
+        self.report_in = None
+        self.report_out = None
+        self.received = deque()     # for read_report() if no raw handler
+        self.received_event = Event()
+
+    def __getstate__(self):
+        state = super(PyWinUsbTransport, self).__getstate__()
+        state.update(report_in=None, report_out=None, received=deque(), received_event=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.received_event = Event()
+
+    def open(self):
+        self.device.open()
+
+        for report in self.device.find_output_reports():
+            #print(report)
+            if self.USAGE_ID_OUTPUT in report:
+                self.report_out = report
+                break
+
+        for report in self.device.find_input_reports():
+            if self.USAGE_ID_INPUT in report:
+                self.report_in = report
+                break
+
+        # self.device.add_event_handler(self.USAGE_ID_INPUT,
+        #                            self.phy_event_handler, usbhid.HID_EVT_ALL)  # level usage
+
+        # reports are memoryview of pywinusb buffers, valid only in the handler
+        self.device.set_raw_data_handler(self.on_raw_data, as_memoryview=True)
+        self.device.set_raw_data_batch_handler(self.on_raw_batch, as_memoryview=True)
+        self.opened = True
+
+        print("HID report out: {}".format(self.report_out))
+        print("HID report in: {}".format(self.report_in))
+
+    def close(self):
+        self.opened = False
+        self.device.close()
+
+    def on_raw_data(self, raw_data):
+        handler = self.raw_handler
+        if handler:
+            handler(raw_data)
+        else:
+            self.received.append(bytes(raw_data))   # kept after the handler returned
+            self.received_event.set()
+
+    def on_raw_batch(self, raw_list):
+        batch_handler = self.raw_batch_handler
+        if batch_handler:
+            batch_handler(raw_list)
+        else:
+            for raw_data in raw_list:
+                self.on_raw_data(raw_data)
+
+    def output_report_size(self):
+        return len(self.report_out[self.USAGE_ID_OUTPUT])
+
+    def write_report(self, data):
+        # raw data is copied into the report buffer and sent, no usage parsing
+        return self.report_out.send(data)
+
+    def read_report(self, timeout=None):
+        self.received_event.clear()
+        if not self.received:
+            self.received_event.wait(timeout)
+
+        if self.received:
+            return self.received.popleft()
+
+class HidPnPHotplug(HotplugSource):
+    "WM_DEVICECHANGE of HID interface, received by a message only window running in its own thread"
+    HWND_MESSAGE = -3
+    WM_QUIT = 0x0012
+
+    class PnPWindow(usbhid.HidPnPWindowMixin):
+        def __init__(self, hwnd, callback):
+            self.callback = callback
+            super(HidPnPHotplug.PnPWindow, self).__init__(hwnd)
+
+        def on_hid_pnp(self, new_status):
+            self.current_status = "unknown" # report every event, not only the status change
+            self.callback()
+            return True
+
+    def __init__(self):
+        super(HidPnPHotplug, self).__init__()
+        self.thread = None
+        self.thread_id = None
+        self.ready = Event()
+
+    def start(self, callback):
+        super(HidPnPHotplug, self).start(callback)
+        self.thread = Thread(target=self.run, name='hotplug:pnp')
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+
+    def stop(self):
+        if self.thread_id:
+            ctypes.windll.user32.PostThreadMessageW(self.thread_id, self.WM_QUIT, 0, 0)
+            self.thread.join()
+            self.thread = self.thread_id = None
+        super(HidPnPHotplug, self).stop()
+
+    def run(self):
+        user32 = ctypes.windll.user32
+        user32.CreateWindowExW.restype = wintypes.HWND
+        user32.CreateWindowExW.argtypes = [wintypes.DWORD, wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.DWORD,
+                                           ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                           wintypes.HWND, wintypes.HMENU, wintypes.HINSTANCE, wintypes.LPVOID]
+        hwnd = user32.CreateWindowExW(0, 'STATIC', self.__class__.__name__, 0, 0, 0, 0, 0,
+                                      self.HWND_MESSAGE, None, None, None)
+        try:
+            window = self.PnPWindow(hwnd, self.notify)
+        except usbhid.HIDError as e:
+            print(self.__class__.__name__, e)
+            user32.DestroyWindow(hwnd)
+            self.ready.set()
+            return
+
+        self.thread_id = ctypes.windll.kernel32.GetCurrentThreadId()
+        self.ready.set()
+
+        msg = wintypes.MSG()
+        while user32.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+            user32.TranslateMessage(ctypes.byref(msg))
+            user32.DispatchMessageW(ctypes.byref(msg))
+
+        window.unhook_wnd_proc()
+        user32.DestroyWindow(hwnd)
@@ -0,0 +1,2 @@
+# the tests import the packages from the repository root (bus, server, ui)
+collect_ignore = ["test_kits.py", "main.py"]  # application modules, not tests
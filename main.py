@@ -1,12 +1,27 @@
 #from multiprocessing import Pipe
+import os
+import sys
 from bus.manage import BusManager
 from bus.hid_bus import Hid_Bus
 #from server.message import ThreadServer
+from server.devinfo import MemMapStructure
 from ui.MainUi import MainUi
 
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pybridgetest', 'object_table')
+
 BusManager.register_bus(Hid_Bus())
 
+def option(name, default=None):
+    "value of '--name=value' in command line"
+    prefix = '--' + name + '='
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
 if __name__ == '__main__':
-    BusManager()
+    # object tables of the known firmware, '--cache-dir=' (empty) to disable
+    MemMapStructure.CACHE_DIR = option('cache-dir', CACHE_DIR) or None
+    BusManager(multi_process='--multi-process' in sys.argv)
     ui = MainUi()
     ui.run()
@@ -1,6 +1,8 @@
 import ctypes
-from ctypes.wintypes import BYTE, WORD
-import array
+from ctypes.wintypes import WORD
+from bisect import bisect_right
+import mmap
+import os
 import struct
 
 UBYTE = ctypes.c_ubyte
@@ -9,6 +11,39 @@ class MemError(Exception):
     "Message error exception class type"
     pass
 
+CRC24_POLY = 0x180001B  # x^24 + x^23 + x^4 + x^3 + x + 1
+CRC24_WORDS = struct.Struct('<8H')
+
+def _crc24_table():
+    "(h << 24) mod poly of each high byte h, to reduce 8 bits at once"
+    table = []
+    for h in range(256):
+        v = h << 24
+        for bit in range(31, 23, -1):
+            if v & (1 << bit):
+                v ^= CRC24_POLY << (bit - 24)
+        table.append(v)
+    return table
+
+CRC24_TABLE = _crc24_table()
+
+def crc24(data, crc=0):
+    """maXTouch information block crc: crc = (crc << 1 ^ word) mod poly of each 16 bits little endian word,
+       the last odd byte is padded with 0. 8 words are merged each step and reduced by table"""
+    data = memoryview(data).cast('B')
+    table = CRC24_TABLE
+    end = len(data) - len(data) % CRC24_WORDS.size
+    for w0, w1, w2, w3, w4, w5, w6, w7 in CRC24_WORDS.iter_unpack(data[:end]):
+        v = (crc << 8) ^ (w0 << 7) ^ (w1 << 6) ^ (w2 << 5) ^ (w3 << 4) ^ (w4 << 3) ^ (w5 << 2) ^ (w6 << 1) ^ w7
+        crc = (v & 0xFFFFFF) ^ table[v >> 24]
+
+    for i in range(end, len(data), 2):
+        word = data[i] | (data[i + 1] << 8 if i + 1 < len(data) else 0)
+        crc = (crc << 1) ^ word
+        if crc & 0x1000000:
+            crc ^= CRC24_POLY
+    return crc
+
 class IdInformation(ctypes.Structure):
     """DEV_BROADCAST_DEVICEINTERFACE ctypes structure wrapper"""
     _fields_ = [
@@ -40,7 +75,10 @@ class Page(object):
     #
     # compond_id is made of OBJECT_ID and INSTANCE_ID
     #
-    def __init__(self, compound_id, offset, length, information=None):
+    # page data is a memoryview window of the device image at the page address (no copy),
+    # the valid map of the image has a non-zero byte for each address which data is saved
+    #
+    def __init__(self, compound_id, offset, length, information=None, image=None, valid=None):
         if isinstance(compound_id, (list, tuple)):
             major, minor = compound_id
         else:
@@ -51,23 +89,30 @@ class Page(object):
         self.minor = minor
         self.offset = offset  # page data offset in mem map
         self.length = length  # page data len
-        # self.cache = array.array('B', [])   #use to store data in split reading
-        self.__buffer = array.array('B', [])  # copy from cache data if split reading complete
+        if image is None:   # standalone page, has its own image
+            image, valid, start = bytearray(length), bytearray(length), 0
+        else:
+            start = offset
+        self.__image = image
+        self.__valid = valid
+        self.__start = start    # page data position in image
+        self.__buffer = memoryview(image)[start: start + length]
         self.info = information
 
         #print(self.__class__.__name__, self.__str__())
 
     def __str__(self):
-        return "Page {}: addr {start}\tlen {len},\tdata {data}".format(self.id(), start=self.addr(), len=self.size(), data=self.buf())
+        return "Page {}: addr {start}\tlen {len},\tdata {data}".format(self.id(), start=self.addr(), len=self.size(),
+                                                                      data=list(self.buf()[:self.data_length()]))
 
     def __repr__(self):
         return super(Page, self).__repr__() + '(' + self.__str__() + ')'
 
     def __iter__(self):
-        return iter(self.__buffer)
+        return iter(self.__buffer[:self.data_length()])
 
     def __getitem__(self, key):
-        if key < len(self.__buffer):
+        if key < self.length and self.__valid[self.__start + key]:
             return self.__buffer[key]
 
     # def compound(self):
@@ -96,57 +141,44 @@ class Page(object):
 
     def clear_buffer(self):
         # self.set_info(None)
-        del self.__buffer[:]
+        self.__valid[self.__start: self.__start + self.length] = bytes(self.length)
 
     def save_to_buffer(self, start, data):
-        if not isinstance(data, type(self.__buffer)):
+        try:
+            size = memoryview(data).nbytes
+        except TypeError:
             MemError("save data type not support {}".format(type(data)))
             return
 
-        if not len(data):
+        if not size:
             MemError("save data length zero {}".format(type(data)))
             return
 
-        # if start != len(self.__buffer):
-        #     MemError("save data offset not support start={} buffer len={}".format(start, len(self.__buffer)))
-        #     return
-        # if start != len(self.__buffer):
-        #     MemError("save data offset not support start={} buffer len={}".format(start, len(self.__buffer)))
-
-        if start + len(data) > self.length:
-            MemError("save data lenght over start+data {} buffer max len={}".format(start + len(data), self.length))
+        if start + size > self.length:
+            MemError("save data lenght over start+data {} buffer max len={}".format(start + size, self.length))
             return
         else:
-            self.__buffer[start: start + len(data)] = data
-            return len(self.__buffer)
-    """
-    def clear_cache(self):
-        del self.cache[:]
-
-    def copy_to_cache(self, start, data):
-        if not isinstance(data, type(self.cache)):
-            ServerError("copyt to cache data type not support {}".format(type(data)))
-
-        if len(data) and start + len(data) <= self.length:
-            self.cache[start: start + len(data)] = data
-    """
+            pos = self.__start + start
+            self.__buffer[start: start + size] = memoryview(data).cast('B')
+            self.__valid[pos: pos + size] = b'\x01' * size
+            return self.data_length()
 
     def buffer_data_valid(self):
-        return self.length and len(self.__buffer) == self.length
+        return self.length and self.data_length() == self.length
 
     def data_length(self):
-        return len(self.__buffer)
-
-    """
-    def save(self):
-        if len(self.cache) == self.length:
-            self.buffer[:] = self.cache[:]
-    """
+        "length of the saved data from page start"
+        end = self.__valid.find(b'\0', self.__start, self.__start + self.length)
+        return self.length if end < 0 else end - self.__start
 
     def buf(self):
-        #return self.__buffer[:]  # array('B')
+        #memoryview of the image, valid until MemMapStructure closed
         return self.__buffer
 
+    def release(self):
+        "release the window, so the mmap image could be closed"
+        self.__buffer.release()
+
     def set_info(self, information):
         self.info = information
 
@@ -191,9 +223,37 @@ class MemMapStructure(object):
     MXT_PROCI_ACTIVESTYLUS_T107 = 107
     """
 
-    def __init__(self):
+    ADDRESS_SPACE = 0x10000 # 16 bits address of maXTouch
+    OBJECT_ELEMENT = struct.Struct("<BHBBB")    # ObjectTableElement
+    INFO_CRC_SIZE = 3   # crc24 of ID information and object table, after the object table
+
+    # parsed object table of each firmware (family, variant, version, build):
+    # (object table data, object tables, page layout [(page id, offset, size)...])
+    _layout_cache = {}
+
+    CACHE_DIR = None    # directory of the object tables saved by ID information, None to disable
+    CACHE_SUFFIX = '.tbl'
+
+    def __init__(self, path=None, cache_dir=None):
+        """The device image covers the whole address space, with the valid map (a byte each address) after it.
+           path: the image is mmap-ed to this file, so other tools could map the same image
+           cache_dir: object tables cache directory, CACHE_DIR if not set"""
+        self.__file = None
+        self.__cache_dir = cache_dir if cache_dir else self.CACHE_DIR
+        self.__table_cached = None  #object table filled from the cache, saved again if the device has another one
+        size = self.ADDRESS_SPACE
+        if path:
+            self.__file = open(path, 'w+b')
+            self.__file.truncate(size * 2)
+            self.__image = mmap.mmap(self.__file.fileno(), size, offset=0)
+            self.__valid = mmap.mmap(self.__file.fileno(), size, offset=size)
+        else:
+            self.__image = bytearray(size)
+            self.__valid = bytearray(size)
+
         self.__pages = {} #buffer to store each object instance
-        self.__pages[Page.ID_INFORMATION] = Page(Page.ID_INFORMATION, 0, len(IdInformation._fields_))
+        self.__index = None #(start address list, page list) sorted by address, rebuilt after page changed
+        self.create_page(Page.ID_INFORMATION, 0, len(IdInformation._fields_))
 
     def __str__(self):
         result = []
@@ -208,14 +268,39 @@ class MemMapStructure(object):
         if key in self.__pages.keys():
             return self.__pages[key]
 
+    def close(self):
+        "release the pages and the image file"
+        for page in self.__pages.values():
+            page.release()
+        self.__pages.clear()
+        self.__index = None
+        if self.__file:
+            self.__image.close()
+            self.__valid.close()
+            self.__file.close()
+            self.__file = None
+
+    def image(self):
+        "memoryview of the whole device image"
+        return memoryview(self.__image)
+
+    def snapshot(self):
+        "copy of the device image and valid map"
+        return bytes(self.__image), bytes(self.__valid)
+
     def create_page(self, page_id, offset, length):
         if length <= 0:
             print(self.__class__.__name__, "create_page size zero", page_id)
             return
 
+        if offset + length > self.ADDRESS_SPACE:
+            print(self.__class__.__name__, "create_page over address space", page_id, offset, length)
+            return
+
         if page_id in self.__pages.keys():
-            del self.__pages[page_id]
-        self.__pages[page_id] = Page(page_id, offset, length)
+            self.__pages.pop(page_id).release()
+        self.__pages[page_id] = Page(page_id, offset, length, image=self.__image, valid=self.__valid)
+        self.__index = None
         return self.get_page(page_id)
 
     def has_page(self, page_id):
@@ -224,10 +309,43 @@ class MemMapStructure(object):
     def get_page(self, page_id):
         return self.__pages.get(page_id, None)
 
+    def build_index(self):
+        "address index of the pages, the pages of memory map are not overlapped"
+        pages = sorted(self.__pages.values(), key=lambda page: page.addr())
+        self.__index = ([page.addr() for page in pages], pages)
+        return self.__index
+
+    def find_page(self, offset):
+        "page which covers the address, None if not in any page"
+        starts, pages = self.__index or self.build_index()
+        i = bisect_right(starts, offset) - 1
+        if i >= 0 and offset < starts[i] + pages[i].size():
+            return pages[i]
+
+    def locate(self, offset):
+        "address to (object type, instance, offset in page), None if not in any page"
+        page = self.find_page(offset)
+        if page:
+            return page.major_id(), page.sub_id(), offset - page.addr()
+
+    def pages_in_range(self, offset, length):
+        "pages overlapped with [offset, offset + length) in address order"
+        starts, pages = self.__index or self.build_index()
+        end = offset + length
+        i = max(bisect_right(starts, offset) - 1, 0)
+        result = []
+        for page in pages[i:]:
+            if page.addr() >= end:
+                break
+            if page.addr() + page.size() > offset:
+                result.append(page)
+        return result
+
     def to_page_name(self, offset):
-        for page in self.__pages.values():
-            if offset > page.offset and offset < page.offset + page.length:
-                return page.name
+        "page id (object type, instance) of the address"
+        page = self.find_page(offset)
+        if page:
+            return page.id()
 
         return None
 
@@ -256,9 +374,101 @@ class MemMapStructure(object):
     """
 
     def check_info_crc(self, page_list):
-        #FIXME: need achieve
+        """crc24 of ID information and object table, the object table page (with the crc) is cleared if not match,
+           so only the object table need to be read again"""
+        id_page, obj_page = page_list['id'], page_list['obj']
+        table_size = obj_page.size() - self.INFO_CRC_SIZE
+        if id_page.addr() + id_page.size() != obj_page.addr() or table_size < 0:
+            print("{} info pages not contiguous".format(self.__class__.__name__))
+            return False
+
+        data = self.image()[id_page.addr(): obj_page.addr() + table_size]
+        crc = crc24(data)
+        expected = int.from_bytes(obj_page.buf()[table_size:], 'little')
+        if crc != expected:
+            print("{} info crc mismatch: calculated {:06x} read {:06x}".format(self.__class__.__name__, crc, expected))
+            obj_page.clear_buffer()
+            return False
+
         return True
 
+    def firmware_id(self):
+        "(family, variant, version, build) of the ID information, None if not parsed"
+        page = self.get_page(Page.ID_INFORMATION)
+        info = page.get_info() if page else None
+        if info:
+            return (info.familiy_id, info.variant_id, info.version, info.build)
+
+    @classmethod
+    def parse_object_table(cls, firmware, data):
+        """Object table data to ({(type, instance): ObjectTableElement}, [(page id, offset, size)...]),
+           decoded in one pass, the same table of the firmware is parsed once"""
+        cached = cls._layout_cache.get(firmware)
+        if cached and cached[0] == data:
+            return cached[1:]
+
+        object_tables = {}
+        layout = []
+        for fields in cls.OBJECT_ELEMENT.iter_unpack(data):
+            element = ObjectTableElement(*fields)
+            type, offset, size_minus_one, instances_minus_one = fields[:4]
+            elem_size = size_minus_one + 1
+            for i in range(instances_minus_one + 1):
+                object_tables[(type, i)] = element
+                layout.append(((type, i), offset, elem_size))
+                offset += elem_size
+
+        cls._layout_cache[firmware] = (bytes(data), object_tables, layout)
+        return object_tables, layout
+
+    def cache_path(self):
+        "object table cache file of the ID information, None if cache disabled"
+        page = self.get_page(Page.ID_INFORMATION)
+        if self.__cache_dir and page and page.buffer_data_valid():
+            return os.path.join(self.__cache_dir, bytes(page.buf()).hex() + self.CACHE_SUFFIX)
+
+    def load_object_table(self, page):
+        """fill the object table page (except the crc) with the table of the same ID information,
+           from the memory cache or the cache file, return the table filled, None if not found"""
+        table_size = page.size() - self.INFO_CRC_SIZE
+        cached = self._layout_cache.get(self.firmware_id())
+        data = cached[0] if cached else None
+        if data is None or len(data) != table_size:
+            path = self.cache_path()
+            if not path:
+                return
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return
+
+        if len(data) != table_size:
+            print("{} object table cache size {} mismatch {}".format(self.__class__.__name__, len(data), table_size))
+            return
+
+        page.save_to_buffer(0, data)
+        return data
+
+    def table_cached(self):
+        "the object table page is filled from the cache, and not checked by the info crc yet"
+        return self.__table_cached is not None
+
+    def save_object_table(self, data):
+        "save the object table to cache file, replaced in one step so other process never reads part of it"
+        path = self.cache_path()
+        if not path:
+            return
+
+        tmp = "{}.{}".format(path, os.getpid())
+        try:
+            os.makedirs(self.__cache_dir, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(self.__class__.__name__, "save object table failed:", e)
+
     def page_parse(self, page_id):
 
         if not self.has_page(page_id):
@@ -279,8 +489,12 @@ class MemMapStructure(object):
             id_infomation = IdInformation(*struct.unpack_from("B" * ctypes.sizeof(IdInformation), data))
             page.set_info(id_infomation)
             offset = page.addr() + page.size()
-            length = id_infomation.object_num * ctypes.sizeof(ObjectTableElement)
-            return self.create_page(Page.OBJECT_TABLE, offset, length)
+            length = id_infomation.object_num * ctypes.sizeof(ObjectTableElement) + self.INFO_CRC_SIZE
+            # the object table of known firmware is filled from cache, then only the data after
+            # data_length() (the crc) need to be read to finish the page
+            table_page = self.create_page(Page.OBJECT_TABLE, offset, length)
+            self.__table_cached = self.load_object_table(table_page) if table_page else None
+            return table_page
         elif page_id == Page.OBJECT_TABLE:
             page_list = {'id':self.get_page(Page.ID_INFORMATION),
                         'obj':self.get_page(Page.OBJECT_TABLE)}
@@ -289,21 +503,19 @@ class MemMapStructure(object):
                 print("{} page value empty".format(self.__class__.__name__))
                 return
 
-            esize = ctypes.sizeof(ObjectTableElement)
-            object_tables = {}
-            for n in range(page_list['id'].get_info().object_num):
-                #print(self.__class__.__name__, data[n * esize: (n + 1) * esize])
-                element = ObjectTableElement(*struct.unpack_from("<BHBBB", data[n * esize: (n + 1) * esize]))
-                offset = element.start_address
-                inst = element.instances_minus_one + 1
-                for i in range(inst):
-                    elem_page_id = (element.type, i)
-                    elem_size = element.size_minus_one + 1
-                    object_tables[elem_page_id] = element
-                    self.create_page(elem_page_id, offset, elem_size)
-                    offset += elem_size
-
-            page_list['obj'].set_info(object_tables)
-            return self.check_info_crc(page_list)
+            table_cached, self.__table_cached = self.__table_cached, None
+            if not self.check_info_crc(page_list):    # cached table is cleared too, read all of it again
+                return False
+
+            table_size = page_list['obj'].size() - self.INFO_CRC_SIZE
+            if table_cached != data[:table_size]:
+                self.save_object_table(data[:table_size])
+            object_tables, layout = self.parse_object_table(self.firmware_id(), data[:table_size])
+            for elem_page_id, offset, elem_size in layout:
+                self.create_page(elem_page_id, offset, elem_size)
+
+            page_list['obj'].set_info(dict(object_tables))
+            self.build_index()
+            return True
         else:   #not need parse
             return True
\ No newline at end of file
@@ -1,4 +1,6 @@
 from collections import deque
+import heapq
+import threading
 import time
 
 class MsgError(Exception):
@@ -6,6 +8,8 @@ class MsgError(Exception):
     pass
 
 class Token(list):
+    __slots__ = ()
+
     def __init__(self, arg):
         if isinstance(arg, list):
             val = arg
@@ -14,13 +18,49 @@ class Token(list):
         super(Token, self).__init__(val)
 
 class BaseMessage(object):
+    """
+    Message objects are recycled by free list: the class which has its own _pool could create object by alloc(),
+    and call release() when the message is consumed, the object must not be used after released.
+    """
+    __slots__ = ('_location', '_type', '_id', '_seq', '_kwargs', '_pdata')
+
+    POOL_SIZE = 64  #max objects kept in each free list, 0 to disable
+    _pool = []
+
     def __init__(self, location, type, id, seq, **kwargs):
         self._location = location
         self._type = type
         self._id = id
         self._seq = seq  # may use Token as sequence
         self._kwargs = kwargs
-        self._pdata = {}
+        self._pdata = None
+
+    @classmethod
+    def alloc(cls, *args, **kwargs):
+        pool = cls.__dict__.get('_pool')
+        if pool:
+            try:
+                obj = pool.pop()
+            except IndexError:  # taken by other thread
+                pass
+            else:
+                obj.__init__(*args, **kwargs)
+                return obj
+
+        return cls(*args, **kwargs)
+
+    def release(self):
+        "put back to the free list of its class"
+        if self._location is None:  # released already
+            return
+
+        self._location = None
+        self._seq = None
+        self._kwargs = None
+        self._pdata = None
+        pool = type(self).__dict__.get('_pool')
+        if pool is not None and len(pool) < self.POOL_SIZE:
+            pool.append(self)
 
     def __repr__(self):
         return super(BaseMessage, self).__repr__() + " " + self.__str__()
@@ -58,6 +98,10 @@ class BaseMessage(object):
         #print("Token {}".format(self._seq))
         return self._seq.copy()
 
+    def seq_key(self):
+        "hashable sequence, used to index the command"
+        return tuple(self._seq)
+
     def extra_info(self):
         return self._kwargs
 
@@ -69,13 +113,29 @@ class BaseMessage(object):
         if 'value' in info.keys():
             return info['value']
 
+    def encode_into(self, buffer, offset=0):
+        "binary encoding to writable buffer, return the end offset, see server.wire"
+        from server import wire
+        return wire.encode_into(self, buffer, offset)
+
+    @staticmethod
+    def decode(buffer):
+        "create BaseMessage from binary encoding, the bytes payload is a memoryview slice of the buffer"
+        from server import wire
+        return wire.decode(buffer)
+
     def get_pdata(self, name):
-        return self._pdata.get('name')
+        if self._pdata:
+            return self._pdata.get(name)
 
     def set_pdata(self, name, value):
-        self._pdata['name'] = value
+        if self._pdata is None:
+            self._pdata = {}
+        self._pdata[name] = value
 
 class Message(BaseMessage):
+    __slots__ = ('pipe', '_timeout_value', '_time', '_status', 'group')
+
     #message name
     (DEVICE, BUS, SERVER, UI) = ('Device', 'Bus', 'Server', 'Ui')
 
@@ -84,6 +144,8 @@ class Message(BaseMessage):
 
     #message type
     (MSG_DEVICE_NAK, MSG_BUS_FOUND, MSG_BRIDGE_ATTACH, MSG_DEVICE_BOOTLOADER, MSG_DEVICE_CONNECTED, MSG_DEVICE_PAGE_READ, MSG_DEVICE_PAGE_WRITE, MSG_DEVICE_BLOCK_READ, MSG_DEVICE_BLOCK_WRITE, MSG_DEVICE_RAW_DATA, MSG_DEVICE_INTERRUPT_DATA, MSG_DEVICE_MSG_OUTPUT) = range(10, 22)
+    MSG_DEVICE_BUSY = 22    #command queue of device is full(True) or has space(False)
+    MSG_BUS_CHANGED = 23    #batch of MSG_BUS_FOUND, value is list of (device key, id, pipes or None if removed)
 
     #command
     (CMD_POLL_BRIDGE, CMD_POLL_DEVICE, CMD_DEVICE_PAGE_READ, CMD_DEVICE_PAGE_WRITE, CMD_DEVICE_BLOCK_READ, CMD_DEVICE_BLOCK_WRITE, CMD_DEVICE_RAW_DATA, CMD_DEVICE_MSG_OUTPUT) = range(100, 108)
@@ -144,8 +206,12 @@ class Message(BaseMessage):
     def ready(self):
         return self.status() == Message.INIT
 
+    def release(self):
+        self.pipe = None
+        super(Message, self).release()
+
     def msg_data(self):
-        return BaseMessage(self.loc(), self.type(), self.id(), self.seq(), **self.extra_info())
+        return BaseMessage.alloc(self.loc(), self.type(), self.id(), self.seq(), **self.extra_info())
 
     def send_to(self, pipe):
         if not pipe:
@@ -171,42 +237,104 @@ class Message(BaseMessage):
         return self.send_to(self.pipe)
 
 class HidMessage(Message):
+    __slots__ = ()
+    _pool = []
+
     def __init__(self, *args, **kwargs):
         super(HidMessage, self).__init__(Message.DEVICE, *args, **kwargs)
 
 class BusMessage(Message):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(BusMessage, self).__init__(Message.BUS, *args, **kwargs)
 
 class ServerMessage(Message):
+    __slots__ = ()
+    _pool = []
+
     def __init__(self, *args, **kwargs):
         super(ServerMessage, self).__init__(Message.SERVER, *args, **kwargs)
 
 class UiMessage(Message):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(UiMessage, self).__init__(Message.UI, *args, **kwargs)
 
 class MessageServer(object):
+    class Notifier(object):
+        "Shared by many pipes, wake up the waiter when any of the pipes got message"
+        def __init__(self):
+            self._cond = threading.Condition()
+            self._flag = False
+
+        def notify(self):
+            with self._cond:
+                self._flag = True
+                self._cond.notify_all()
+
+        def wait(self, timeout=None):
+            with self._cond:
+                if not self._flag:
+                    self._cond.wait(timeout)
+                flag = self._flag
+                self._flag = False
+                return flag
+
     class mPipe(object):
+        "Thread safe message queue, poll()/recv() will block until message arrived or timeout(None for infinite)"
         def __init__(self, category):
             self._ctg = category
             self._msg = deque()
+            self._cond = threading.Condition()
+            self._closed = False
+            self._listeners = []
 
         def category(self):
             return self._ctg
 
+        def listen(self, callback):
+            "callback() is called (may be in sender thread) after each message arrived"
+            with self._cond:
+                if callback not in self._listeners:
+                    self._listeners.append(callback)
+
+        def unlisten(self, callback):
+            with self._cond:
+                if callback in self._listeners:
+                    self._listeners.remove(callback)
+
         def send(self, msg):
-            self._msg.appendleft(msg)
+            with self._cond:
+                self._msg.appendleft(msg)
+                self._cond.notify_all()
+                listeners = self._listeners[:]
+
+            for callback in listeners:
+                callback()
 
-        def recv(self):
-            if len(self._msg):
-                return self._msg.pop()
+        def recv(self, timeout=0):
+            with self._cond:
+                if self._cond.wait_for(lambda: len(self._msg) or self._closed, timeout):
+                    if len(self._msg):
+                        return self._msg.pop()
+
+                    raise EOFError("Pipe {} closed".format(self._ctg))
 
         def poll(self, timeout=0):
-            return len(self._msg)
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._msg) or self._closed, timeout)
+                return len(self._msg) or self._closed     # closed pipe reports EOFError in recv()
 
         def close(self):
-            pass
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+                listeners = self._listeners[:]
+
+            for callback in listeners:
+                callback()
 
     (BUS_TO_SERVER, ) = range(1)
     _categories = {}
@@ -223,6 +351,11 @@ class MessageServer(object):
     def get(cls, category):
         return cls._categories.get(category)
 
+    @classmethod
+    def attach(cls, category, pipe):
+        "use a pipe object created outside, e.g. the pipe to other process"
+        cls._categories[category] = pipe
+
     @classmethod
     def open(cls, category):
         if category not in cls._categories.keys():
@@ -254,38 +387,249 @@ class MessageServer(object):
 
     @classmethod
     def wait(cls, pipes, timeout=None):
+        "Block until any of the pipes has message or timeout(None for infinite), return the ready pipes list"
+        ready = [p for p in pipes if p.poll()]
+        if ready or timeout == 0:
+            return ready
+
+        deadline = None if timeout is None else time.time() + timeout
+        notifier = MessageServer.Notifier()
         for p in pipes:
-            len = p.poll()
-            if len:
-                yield p
+            p.listen(notifier.notify)
+
+        try:
+            while True:
+                ready = [p for p in pipes if p.poll()]
+                if ready:
+                    return ready
+
+                if deadline is None:
+                    notifier.wait()
+                else:
+                    remain = deadline - time.time()
+                    if remain <= 0:
+                        return ready
+                    notifier.wait(remain)
+        finally:
+            for p in pipes:
+                p.unlisten(notifier.notify)
 
 class ThreadServer(object):
+    """
+    Scheduler of the registered process. Each entry is kept in a min-heap keyed by the next due time,
+    the entry is run when it's due, or woken up by wakeup() or a message arrived in the watched pipe.
+    interval:
+        number: seconds between two runs
+        callable: return the seconds to next run after each run, None for waiting the wakeup only
+    """
     _objects = []
+    _heap = []
+    _order = 0
+    _cond = threading.Condition(threading.RLock())
 
     (CRITICAL, HIGH, MIDDLE, LOW) = range(4)
     PRIORITY_DEFAULT = MIDDLE
 
     @classmethod
-    def register(cls, category, process, args=tuple(), priority=PRIORITY_DEFAULT, interval=0):
-        d = dict(cat=category, proc=process, args=args, pri=priority, itv=interval, lt=time.time())
-        cls._objects.append(d)
-        cls._objects.sort(key=lambda a: (a['pri'], a['cat']))
+    def register(cls, category, process, args=tuple(), priority=PRIORITY_DEFAULT, interval=0, pipes=tuple()):
+        d = dict(cat=category, proc=process, args=args, pri=priority, itv=interval, lt=time.time(),
+                 due=None, gen=0, pipes=[], active=True)
+        d['wake'] = lambda: cls._wakeup_entry(d)
+        with cls._cond:
+            cls._objects.append(d)
+            cls._objects.sort(key=lambda a: (a['pri'], a['cat']))
+            cls._schedule(d, time.time())
+            cls._cond.notify_all()
+
+        for p in pipes:
+            cls.watch(category, process, p)
+
+        return d
 
     @classmethod
     def unregister(cls, category, process):
-        for i, obj in enumerate(cls._objects[:]):
-            if obj['cat'] == category and obj['proc'] == process:
-                cls._objects.pop(i)
-                break
+        with cls._cond:
+            for i, obj in enumerate(cls._objects[:]):
+                if obj['cat'] == category and obj['proc'] == process:
+                    cls._objects.pop(i)
+                    obj['active'] = False
+                    obj['gen'] += 1     # invalid the item in heap
+                    obj['due'] = None
+                    for p in obj['pipes']:
+                        p.unlisten(obj['wake'])
+                    del obj['pipes'][:]
+                    break
+
+    @classmethod
+    def _find(cls, category, process=None):
+        return [obj for obj in cls._objects if obj['cat'] == category and (process is None or obj['proc'] == process)]
+
+    @classmethod
+    def watch(cls, category, process, pipe):
+        "message arrived in the pipe will wake up the entry"
+        with cls._cond:
+            for obj in cls._find(category, process):
+                if pipe not in obj['pipes']:
+                    obj['pipes'].append(pipe)
+                    pipe.listen(obj['wake'])
+                    if pipe.poll():     # message arrived before watching
+                        cls._wakeup_entry(obj)
+
+    @classmethod
+    def unwatch(cls, category, process, pipe):
+        with cls._cond:
+            for obj in cls._find(category, process):
+                if pipe in obj['pipes']:
+                    obj['pipes'].remove(pipe)
+                    pipe.unlisten(obj['wake'])
+
+    @classmethod
+    def wakeup(cls, category, process=None):
+        "let the entry run at next process(), this could be called in any thread"
+        with cls._cond:
+            for obj in cls._find(category, process):
+                cls._wakeup_entry(obj)
+
+    @classmethod
+    def _wakeup_entry(cls, obj):
+        with cls._cond:
+            if not obj['active']:
+                return
+
+            now = time.time()
+            if obj['due'] is None or obj['due'] > now:
+                cls._push(obj, now)
+            cls._cond.notify_all()
+
+    @classmethod
+    def _push(cls, obj, due):
+        obj['due'] = due
+        obj['gen'] += 1
+        cls._order += 1
+        heapq.heappush(cls._heap, (due, obj['pri'], cls._order, obj['gen'], obj))
+
+    @classmethod
+    def _schedule(cls, obj, now):
+        interval = obj['itv']
+        if callable(interval):
+            interval = interval()
+
+        if interval is None:
+            obj['due'] = None
+            obj['gen'] += 1
+        else:
+            cls._push(obj, now + max(interval, 0))
+
+    @classmethod
+    def _valid(cls, item):
+        due, pri, order, gen, obj = item
+        return gen == obj['gen'] and obj['due'] is not None
+
+    @classmethod
+    def next_delay(cls):
+        "seconds to the nearest due entry, None if nothing scheduled"
+        with cls._cond:
+            heap = cls._heap
+            while heap and not cls._valid(heap[0]):
+                heapq.heappop(heap)
+
+            if heap:
+                return max(heap[0][0] - time.time(), 0)
+
+    @classmethod
+    def wait(cls, timeout=None):
+        "sleep until next entry is due, or woken up, or timeout(None for infinite)"
+        with cls._cond:
+            delay = cls.next_delay()
+            if timeout is not None:
+                delay = timeout if delay is None else min(delay, timeout)
+
+            if delay is None or delay > 0:
+                cls._cond.wait(delay)
 
     @classmethod
     def process(cls):
-        for obj in cls._objects:
-            last_time = obj['lt']
-            elapsed = time.time() - last_time
-            if elapsed >= obj['itv']:
-                proc = obj.get('proc')
-                args = obj.get('args')
-                if proc:
-                    proc(*args)
-                    obj['lt'] = time.time()
\ No newline at end of file
+        now = time.time()
+        due_list = []
+        with cls._cond:
+            heap = cls._heap
+            while heap and heap[0][0] <= now:
+                item = heapq.heappop(heap)
+                if cls._valid(item):
+                    obj = item[-1]
+                    obj['due'] = None
+                    obj['gen'] += 1
+                    due_list.append(obj)
+
+        due_list.sort(key=lambda a: (a['pri'], a['cat']))
+        for obj in due_list:
+            if not obj['active']:
+                continue
+
+            proc = obj.get('proc')
+            args = obj.get('args')
+            if proc:
+                proc(*args)
+                obj['lt'] = time.time()
+
+            with cls._cond:
+                if obj['active'] and obj['due'] is None:   # not woken up during running
+                    cls._schedule(obj, obj['lt'])
+
+class DeadlineTimer(object):
+    """
+    Deadlines (command timeout, repeat...) shared by the devices on a bus or the screen, kept in a min-heap,
+    the callback is called in ThreadServer when due. Cancelled entry is left in heap and dropped when popped.
+    """
+    (DUE, ORDER, CALLBACK, ARGS) = range(4)
+
+    def __init__(self):
+        self._heap = []
+        self._order = 0
+        self._lock = threading.Lock()
+        ThreadServer.register(self.__class__.__name__, self.expire, interval=self.next_delay)
+
+    def add(self, delay, callback, *args):
+        "call callback(*args) after delay seconds, return the entry for cancel()"
+        with self._lock:
+            self._order += 1
+            entry = [time.time() + delay, self._order, callback, args]
+            heapq.heappush(self._heap, entry)
+            earliest = self._heap[0] is entry
+
+        if earliest:
+            ThreadServer.wakeup(self.__class__.__name__, self.expire)    # reschedule with the new deadline
+        return entry
+
+    def cancel(self, entry):
+        if entry:
+            entry[self.CALLBACK] = None
+
+    def close(self):
+        "unregister from ThreadServer, the deadlines left are dropped"
+        ThreadServer.unregister(self.__class__.__name__, self.expire)
+        with self._lock:
+            del self._heap[:]
+
+    def next_delay(self):
+        "seconds to the nearest deadline, None if nothing"
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][self.CALLBACK] is None:
+                heapq.heappop(heap)
+
+            if heap:
+                return max(heap[0][self.DUE] - time.time(), 0)
+
+    def expire(self):
+        now = time.time()
+        due_list = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][self.DUE] <= now:
+                entry = heapq.heappop(heap)
+                if entry[self.CALLBACK]:
+                    due_list.append((entry[self.CALLBACK], entry[self.ARGS]))
+
+        for callback, args in due_list:
+            callback(*args)
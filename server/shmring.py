@@ -0,0 +1,235 @@
+"""
+Single producer / single consumer ring buffer in shared memory, used to transfer message between processes
+
+Only the producer moves the head and only the consumer moves the tail, so no lock is needed on the data,
+the events are used to wake up the other side only.
+
+shared memory layout:
+    header: head(Q) tail(Q) closed(Q) capacity(Q) ... (HEADER_SIZE)
+    data: [length(I) + record] ...
+"""
+import struct
+import time
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+from server.message import BaseMessage, MsgError
+
+class ShmRing(object):
+    HEADER_SIZE = 64
+    (HEAD, TAIL, CLOSED, CAPACITY) = range(4)
+    LENGTH = struct.Struct('<I')
+
+    def __init__(self, capacity=0, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER_SIZE + capacity)
+            self.owner = True
+        else:
+            self.shm = self.attach(name)
+            self.owner = False
+
+        self._ctrl = self.shm.buf[:self.HEADER_SIZE].cast('Q')
+        if self.owner:
+            self._ctrl[self.HEAD] = 0
+            self._ctrl[self.TAIL] = 0
+            self._ctrl[self.CLOSED] = 0
+            self._ctrl[self.CAPACITY] = capacity
+
+        self.capacity = self._ctrl[self.CAPACITY]
+        self._data = self.shm.buf[self.HEADER_SIZE: self.HEADER_SIZE + self.capacity]
+
+    @staticmethod
+    def attach(name):
+        "attach the exist shared memory, only the creator should unlink it"
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:   # python < 3.13, the child process shares resource tracker of the creator
+            return shared_memory.SharedMemory(name=name)
+
+    def name(self):
+        return self.shm.name
+
+    def used(self):
+        return self._ctrl[self.HEAD] - self._ctrl[self.TAIL]
+
+    def empty(self):
+        return self._ctrl[self.HEAD] == self._ctrl[self.TAIL]
+
+    def _copy_in(self, pos, data):
+        size = len(data)
+        offset = pos % self.capacity
+        first = min(size, self.capacity - offset)
+        self._data[offset: offset + first] = data[:first]
+        if first < size:
+            self._data[:size - first] = data[first:]
+
+    def _copy_out(self, pos, size):
+        offset = pos % self.capacity
+        first = min(size, self.capacity - offset)
+        result = bytearray(self._data[offset: offset + first])
+        if first < size:
+            result += self._data[:size - first]
+        return result
+
+    def write(self, data):
+        "producer side, return False if no enough space"
+        need = self.LENGTH.size + len(data)
+        head = self._ctrl[self.HEAD]
+        if need > self.capacity - (head - self._ctrl[self.TAIL]):
+            return False
+
+        self._copy_in(head, self.LENGTH.pack(len(data)))
+        self._copy_in(head + self.LENGTH.size, data)
+        self._ctrl[self.HEAD] = head + need     # publish after data is ready
+        return True
+
+    def read(self):
+        "consumer side, return None if empty"
+        tail = self._ctrl[self.TAIL]
+        if tail == self._ctrl[self.HEAD]:
+            return None
+
+        size, = self.LENGTH.unpack(self._copy_out(tail, self.LENGTH.size))
+        data = self._copy_out(tail + self.LENGTH.size, size)
+        self._ctrl[self.TAIL] = tail + self.LENGTH.size + size
+        return data
+
+    def closed(self):
+        return bool(self._ctrl[self.CLOSED])
+
+    def close(self):
+        self._ctrl[self.CLOSED] = 1
+
+    def release(self):
+        self._ctrl.release()
+        self._data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class ShmChannel(object):
+    "One direction message channel between two processes, could be passed to the child process as argument"
+    CAPACITY = 64 * 1024
+    SEND_TIMEOUT = 1 #second, wait for the consumer when the ring is full
+    SCRATCH_SIZE = 256  #encoding buffer, grow if message is larger
+
+    def __init__(self, context=multiprocessing, capacity=CAPACITY):
+        self.ring = ShmRing(capacity)
+        self.data_event = context.Event()
+        self.space_event = context.Event()
+        self.scratch = bytearray(self.SCRATCH_SIZE)
+        self.send_lock = threading.Lock()   # single producer, serialize the threads in this process
+
+    def __getstate__(self):
+        return dict(name=self.ring.name(), data_event=self.data_event, space_event=self.space_event)
+
+    def __setstate__(self, state):
+        self.ring = ShmRing(name=state['name'])
+        self.data_event = state['data_event']
+        self.space_event = state['space_event']
+        self.scratch = bytearray(self.SCRATCH_SIZE)
+        self.send_lock = threading.Lock()
+
+    def encode(self, msg):
+        """encode into the reused scratch buffer, return the memoryview of encoded data,
+           raise MsgError if the message is larger than the ring"""
+        limit = self.ring.capacity - ShmRing.LENGTH.size
+        while True:
+            try:
+                size = msg.encode_into(self.scratch)
+                return memoryview(self.scratch)[:size]
+            except IndexError:
+                if len(self.scratch) >= limit:
+                    raise MsgError("Message encoded over ring capacity {}".format(limit))
+                self.scratch = bytearray(min(len(self.scratch) * 4, limit))
+
+    def send(self, msg, timeout=SEND_TIMEOUT):
+        with self.send_lock:
+            try:
+                data = self.encode(msg)
+            except (MsgError, struct.error, ValueError, TypeError) as e:
+                print(self.__class__.__name__, "send failed, encode", msg, e)
+                return False
+            deadline = time.time() + timeout
+            while not self.ring.write(data):
+                remain = deadline - time.time()
+                if remain <= 0 or self.ring.closed():
+                    print(self.__class__.__name__, "send failed, ring full", msg)
+                    return False
+                self.space_event.clear()
+                if not self.ring.write(data):
+                    self.space_event.wait(remain)
+                    continue
+                break
+
+        self.data_event.set()
+        return True
+
+    def recv_all(self):
+        "drain all the messages in the ring"
+        while True:
+            data = self.ring.read()
+            if data is None:
+                break
+            yield BaseMessage.decode(data)    # payload refers to data, no more copy
+        self.space_event.set()
+
+    def wait(self, timeout=None):
+        self.data_event.wait(timeout)
+        self.data_event.clear()
+
+    def closed(self):
+        return self.ring.closed()
+
+    def close(self):
+        self.ring.close()
+        self.data_event.set()
+        self.space_event.set()
+
+    def release(self):
+        self.ring.release()
+
+    def pump(self, pipe):
+        "forward the messages from the ring to local pipe in a thread, until the channel closed"
+        def run():
+            while True:
+                self.wait()
+                for msg in self.recv_all():
+                    pipe.send(msg)
+
+                if self.closed():
+                    pipe.close()
+                    break
+
+        t = threading.Thread(target=run, name='pump:' + pipe.category())
+        t.daemon = True
+        t.start()
+        return t
+
+class ShmPipe(object):
+    "Send only pipe to the other process, same interface of MessageServer.mPipe.send()"
+    def __init__(self, category, channel):
+        self._ctg = category
+        self.channel = channel
+
+    def category(self):
+        return self._ctg
+
+    def send(self, msg):
+        return self.channel.send(msg)
+
+    def poll(self, timeout=0):
+        return 0
+
+    def recv(self, timeout=0):
+        return None
+
+    def listen(self, callback):
+        pass
+
+    def unlisten(self, callback):
+        pass
+
+    def close(self):
+        self.channel.close()
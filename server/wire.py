@@ -0,0 +1,234 @@
+"""
+Compact binary encoding of BaseMessage, used to transfer message through pipe or shared memory between processes
+
+message:
+    header: version(B) location(B) type(H) kwargs count(B)
+    [location(str)]     only if location code is LOC_OTHER
+    id(value)
+    seq: count(varint) token(zigzag varint)...
+    kwargs: [key(B) [key(str) if KEY_OTHER] value]...
+value:
+    tag(B) + data, bytes-like payload is decoded as memoryview slice of the input buffer (zero copy),
+    so it's only valid while the buffer is not reused
+str:
+    length(varint) utf-8 data
+"""
+import array
+import struct
+
+from server.message import BaseMessage, Token, MsgError
+
+VERSION = 1
+MAX_SIZE = 16 * 1024 * 1024     # encoded message limit, the encoding buffer is not grown over it
+
+HEADER = struct.Struct('<BBHB')
+_Q = struct.Struct('<q')
+_D = struct.Struct('<d')
+
+# location / keyword code, 0 means the string follows
+LOC_OTHER = KEY_OTHER = 0
+LOCATIONS = (None, 'Device', 'Bus', 'Server', 'Ui', 'HID cmd', 'HID Device')
+KEYS = (None, 'value', 'addr', 'size', 'repeat', 'parent_type', 'event')
+_LOCATION_CODE = {name: i for i, name in enumerate(LOCATIONS) if name}
+_KEY_CODE = {name: i for i, name in enumerate(KEYS) if name}
+
+(TAG_NONE, TAG_TRUE, TAG_FALSE, TAG_INT, TAG_FLOAT, TAG_STR, TAG_BYTES, TAG_LIST, TAG_TUPLE, TAG_BIGINT) = b'NTFidsbltI'
+
+def _put_varint(buf, pos, v):
+    while v >= 0x80:
+        buf[pos] = (v & 0x7f) | 0x80
+        v >>= 7
+        pos += 1
+    buf[pos] = v
+    return pos + 1
+
+def _get_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def _put_sint(buf, pos, v):
+    return _put_varint(buf, pos, (v << 1) if v >= 0 else ((-v << 1) - 1))
+
+def _get_sint(buf, pos):
+    v, pos = _get_varint(buf, pos)
+    return (v >> 1) if not v & 1 else -((v + 1) >> 1), pos
+
+def _check_space(buf, pos, size):
+    if pos + size > len(buf):
+        raise IndexError("buffer too small")
+
+def _put_bytes(buf, pos, data):
+    pos = _put_varint(buf, pos, len(data))
+    end = pos + len(data)
+    _check_space(buf, pos, len(data))
+    buf[pos: end] = data
+    return end
+
+def _put_str(buf, pos, s):
+    return _put_bytes(buf, pos, s.encode('utf-8'))
+
+def _get_str(buf, pos):
+    size, pos = _get_varint(buf, pos)
+    return str(buf[pos: pos + size], 'utf-8'), pos + size
+
+def _put_value(buf, pos, v):
+    if v is None:
+        buf[pos] = TAG_NONE
+        pos += 1
+    elif v is True:
+        buf[pos] = TAG_TRUE
+        pos += 1
+    elif v is False:
+        buf[pos] = TAG_FALSE
+        pos += 1
+    elif isinstance(v, int):
+        if -(1 << 62) <= v < (1 << 62):
+            buf[pos] = TAG_INT
+            pos = _put_sint(buf, pos + 1, v)
+        else:
+            buf[pos] = TAG_BIGINT
+            pos = _put_str(buf, pos + 1, str(v))
+    elif isinstance(v, float):
+        buf[pos] = TAG_FLOAT
+        _check_space(buf, pos + 1, _D.size)
+        _D.pack_into(buf, pos + 1, v)
+        pos += 1 + _D.size
+    elif isinstance(v, str):
+        buf[pos] = TAG_STR
+        pos = _put_str(buf, pos + 1, v)
+    elif isinstance(v, (bytes, bytearray)) or (isinstance(v, array.array) and v.typecode == 'B'):
+        buf[pos] = TAG_BYTES
+        pos = _put_bytes(buf, pos + 1, v)
+    elif isinstance(v, memoryview):
+        buf[pos] = TAG_BYTES
+        pos = _put_bytes(buf, pos + 1, v.cast('B') if v.format != 'B' else v)
+    elif isinstance(v, (list, tuple)):
+        buf[pos] = TAG_TUPLE if isinstance(v, tuple) else TAG_LIST
+        pos = _put_varint(buf, pos + 1, len(v))
+        for a in v:
+            pos = _put_value(buf, pos, a)
+    else:
+        raise MsgError("Unsupport value type {}".format(type(v)))
+
+    return pos
+
+def _get_value(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag == TAG_NONE:
+        return None, pos
+    elif tag == TAG_TRUE:
+        return True, pos
+    elif tag == TAG_FALSE:
+        return False, pos
+    elif tag == TAG_INT:
+        return _get_sint(buf, pos)
+    elif tag == TAG_BIGINT:
+        s, pos = _get_str(buf, pos)
+        return int(s), pos
+    elif tag == TAG_FLOAT:
+        return _D.unpack_from(buf, pos)[0], pos + _D.size
+    elif tag == TAG_STR:
+        return _get_str(buf, pos)
+    elif tag == TAG_BYTES:
+        size, pos = _get_varint(buf, pos)
+        return buf[pos: pos + size], pos + size
+    elif tag in (TAG_LIST, TAG_TUPLE):
+        count, pos = _get_varint(buf, pos)
+        result = []
+        for i in range(count):
+            v, pos = _get_value(buf, pos)
+            result.append(v)
+        if tag == TAG_TUPLE:
+            result = tuple(result)
+        return result, pos
+    else:
+        raise MsgError("Unknown value tag {}".format(tag))
+
+def encode_into(msg, buffer, offset=0):
+    """Encode BaseMessage into writable buffer (bytearray, memoryview...) start at offset,
+       return the end offset, raise IndexError if the buffer is too small,
+       struct.error/ValueError/TypeError if the message could not be encoded (retry with larger buffer not help)"""
+    loc = msg.loc()
+    info = msg.extra_info()
+    loc_code = _LOCATION_CODE.get(loc, LOC_OTHER)
+    _check_space(buffer, offset, HEADER.size)
+    HEADER.pack_into(buffer, offset, VERSION, loc_code, msg.type(), len(info))
+    pos = offset + HEADER.size
+    if loc_code == LOC_OTHER:
+        pos = _put_str(buffer, pos, loc)
+
+    pos = _put_value(buffer, pos, msg.id())
+
+    seq = msg._seq
+    pos = _put_varint(buffer, pos, len(seq))
+    for t in seq:
+        pos = _put_sint(buffer, pos, t)
+
+    for k, v in info.items():
+        key_code = _KEY_CODE.get(k, KEY_OTHER)
+        buffer[pos] = key_code
+        pos += 1
+        if key_code == KEY_OTHER:
+            pos = _put_str(buffer, pos, k)
+        pos = _put_value(buffer, pos, v)
+
+    return pos
+
+def decode_from(buffer, offset=0):
+    "Decode BaseMessage from bytes-like object start at offset, return (message, end offset)"
+    buf = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+    version, loc_code, type, count = HEADER.unpack_from(buf, offset)
+    if version != VERSION:
+        raise MsgError("Unsupport message version {}".format(version))
+
+    pos = offset + HEADER.size
+    if loc_code == LOC_OTHER:
+        loc, pos = _get_str(buf, pos)
+    else:
+        loc = LOCATIONS[loc_code]
+
+    id, pos = _get_value(buf, pos)
+
+    size, pos = _get_varint(buf, pos)
+    seq = Token([])
+    for i in range(size):
+        t, pos = _get_sint(buf, pos)
+        seq.append(t)
+
+    kwargs = {}
+    for i in range(count):
+        key_code = buf[pos]
+        pos += 1
+        if key_code == KEY_OTHER:
+            k, pos = _get_str(buf, pos)
+        else:
+            k = KEYS[key_code]
+        kwargs[k], pos = _get_value(buf, pos)
+
+    return BaseMessage.alloc(loc, type, id, seq, **kwargs), pos
+
+def decode(buffer):
+    "Decode BaseMessage from bytes-like object"
+    return decode_from(buffer)[0]
+
+def encode(msg):
+    "BaseMessage to a new bytearray, raise MsgError if larger than MAX_SIZE"
+    size = 256
+    while True:
+        buf = bytearray(size)
+        try:
+            end = encode_into(msg, buf)
+        except IndexError:
+            if size >= MAX_SIZE:
+                raise MsgError("Message encoded over {} bytes".format(MAX_SIZE))
+            size = min(size * 4, MAX_SIZE)
+            continue
+        del buf[end:]
+        return buf
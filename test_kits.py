@@ -22,6 +22,14 @@ class TestKits(object):
     def timeout(self, interval_timeout):
         return time.time() - self.ticks > interval_timeout
 
+    def next_delay(self):
+        "seconds to the next poll() due, 0 if now"
+        if not self.ticks:
+            return 0
+
+        interval = self.TEST_FRAME_INIT_TIME if self.is_frame(self.F_ST) else self.PWM_PULSE_ASSERT_TIME
+        return max(self.ticks + interval - time.time(), 0)
+
     def fid(self):
         return self.frame %self.TEST_ASSERT_LOOP_COUNT
 
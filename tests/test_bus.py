@@ -0,0 +1,123 @@
+import os
+import selectors
+
+import pytest
+
+from bus.hotplug import HotplugSource
+from bus.manage import BusManager
+from bus.simulated import SimulatedBus, SimulatedTransport
+from bus.transport import HidrawTransport, Transport
+from server.message import BusMessage, Message, MessageServer
+from ui.MainUi import MainScreen
+
+class FailedHotplug(HotplugSource):
+    def start(self, callback):
+        raise PermissionError("netlink not permitted")
+
+def test_need_refresh_keeps_later_change():
+    bus = SimulatedBus()
+    assert bus.start_hotplug(lambda: None)
+    assert bus.need_refresh()   # first enumeration
+    assert not bus.need_refresh()
+    bus.hotplug.arrive()
+    assert bus.need_refresh()
+    assert not bus.need_refresh()
+    bus.stop_hotplug()
+
+def test_hotplug_failed_falls_back_to_polling(monkeypatch):
+    bus = SimulatedBus()
+    bus.set_hotplug(FailedHotplug())
+    monkeypatch.setattr(BusManager, 'BUS_TABLE', [bus])
+    manager = BusManager()
+    try:
+        assert manager.polling
+        assert manager.poll_interval() == BusManager.BUS_REFRESH_TIME
+        bus.need_refresh()
+        assert bus.need_refresh()   # polled bus always refreshes
+    finally:
+        manager.stop()
+
+class PortTransport(SimulatedTransport):
+    "identified by the port only, as hidraw device by HID_PHYS"
+    def device_key(self):
+        return ('port', self.parent_instance_id)
+
+def changes(bus, phys):
+    pipe = MessageServer.mPipe('test:bus')
+    bus.add_or_remove_phy_devices(phys, pipe)
+    events = [(key, id, bool(val)) for key, id, val in pipe.recv().value()] if pipe.poll() else []
+    return events
+
+def test_diff_replugged_device():
+    bus = SimulatedBus()
+    a, b = PortTransport('node0', 'usb-1'), PortTransport('node1', 'usb-2')
+    try:
+        assert changes(bus, [a, b]) == [(('port', 'usb-1'), 'node0', True), (('port', 'usb-2'), 'node1', True)]
+        assert changes(bus, [a, b]) == []
+        # re-plugged between two refresh, renumbered node on the same port
+        a2 = PortTransport('node5', 'usb-1')
+        assert changes(bus, [a2, b]) == [(('port', 'usb-1'), 'node0', False), (('port', 'usb-1'), 'node5', True)]
+        assert bus.devices[('port', 'usb-1')].id() == 'node5'
+        assert changes(bus, [b]) == [(('port', 'usb-1'), 'node5', False)]
+    finally:
+        for dev in bus.devices.values():
+            dev.stop()
+
+def test_hidraw_key_is_physical_path():
+    node = HidrawTransport('/dev/hidraw3', '0003:03EB:2135.000A', 'usb-0000:00:14.0-2/input0',
+                           vendor_id=0x03EB, product_id=0x2135)
+    replugged = HidrawTransport('/dev/hidraw4', '0003:03EB:2135.000B', 'usb-0000:00:14.0-2/input0',
+                                vendor_id=0x03EB, product_id=0x2135)
+    assert node.device_key() == replugged.device_key()
+    assert HidrawTransport('/dev/hidraw3').device_key() == ('/dev/hidraw3', None)
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        Transport('x')
+
+def pipe_transport(**kwargs):
+    "hidraw transport reading the pipe instead of the node"
+    phy = HidrawTransport('pipe', report_size=8, **kwargs)
+    phy.fd, w = os.pipe()
+    os.set_blocking(phy.fd, False)
+    phy.selector = selectors.DefaultSelector()
+    phy.selector.register(phy.fd, selectors.EVENT_READ)
+    return phy, w
+
+def test_hidraw_short_report():
+    phy, w = pipe_transport()
+    try:
+        os.write(w, b'\x01\x02\x03')
+        assert phy.read_report(0) == b'\x00\x01\x02\x03'
+        os.write(w, bytes(range(1, 9)))
+        assert phy.read_report(0) == b'\x00' + bytes(range(1, 9))
+        assert phy.read_report(0) is None
+        os.close(w)
+        w = None
+        assert phy.read_report(0) is None   # readable with nothing read
+    finally:
+        if w is not None:
+            os.close(w)
+        phy.close()
+
+def test_hidraw_numbered_short_report():
+    phy, w = pipe_transport(report_id=3)
+    try:
+        os.write(w, b'\x03\x10')
+        assert phy.read_report(0) == b'\x03\x10'
+    finally:
+        os.close(w)
+        phy.close()
+
+def test_screen_keeps_device_key():
+    screen = MainScreen()
+    key = ('port', 'usb-1')
+    pipes = (MessageServer.mPipe('k:logic'), MessageServer.mPipe('k:phy'))
+    msg = BusMessage(Message.MSG_BUS_CHANGED, 'bus', Message.seq_root(), value=[(key, 'node0', pipes)])
+    screen.handle_bus_changed_msg(msg)
+    assert screen.devices[key].id() == 'node0'
+    pipes = (MessageServer.mPipe('k2:logic'), MessageServer.mPipe('k2:phy'))
+    msg = BusMessage(Message.MSG_BUS_CHANGED, 'bus', Message.seq_root(),
+                     value=[(key, 'node0', None), (key, 'node5', pipes)])
+    screen.handle_bus_changed_msg(msg)
+    assert list(screen.devices) == [key] and screen.devices[key].id() == 'node5'
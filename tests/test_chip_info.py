@@ -0,0 +1,130 @@
+import os
+import time
+
+import pytest
+
+from bus.hid_bus import Hid_Device
+from bus.simulated import MxtMemory, SimulatedTransport
+from server.devinfo import MemMapStructure, Page, crc24
+from server.message import ThreadServer
+from ui.MainUi import LogicDevice
+
+@pytest.fixture(autouse=True)
+def no_layout_cache(monkeypatch):
+    "each test starts as a new host, the cache directory is set by the test"
+    monkeypatch.setattr(MemMapStructure, '_layout_cache', {})
+    monkeypatch.setattr(MemMapStructure, 'CACHE_DIR', None)
+
+class CorruptedMemory(MxtMemory):
+    "the object table read is corrupted (a bit flipped) the first count times"
+    def __init__(self, count):
+        super(CorruptedMemory, self).__init__()
+        self.count = count
+        self.reads = []
+
+    def read(self, addr, size):
+        data = super(CorruptedMemory, self).read(addr, size)
+        self.reads.append((addr, size))
+        if addr == self.ID_SIZE and self.count:
+            self.count -= 1
+            data = bytearray(data)
+            data[10] ^= 0x01
+        return data
+
+def connect(memory):
+    "logic device after the chip info read"
+    dev = Hid_Device(SimulatedTransport('chip', memory=memory, latency=0))
+    dev.start()
+    logic = LogicDevice(dev.id(), dev.attach_info())
+    logic.set_get_chip_info()
+    deadline = time.time() + 2
+    try:
+        while (logic.cmd_list or logic.cmd_pending) and time.time() < deadline:
+            logic.send_command()
+            ThreadServer.process()
+            while logic.logic_pipe.poll(0.001):
+                msg = logic.logic_pipe.recv()
+                logic.handle_message(msg)
+                msg.release()
+    finally:
+        dev.stop()
+    return logic
+
+def read_chip_info(memory):
+    return connect(memory).mem_map
+
+def reads(memory):
+    "(ID information, object table) reads, a block may be read in several chunks"
+    starts = [addr for addr, size in memory.reads]
+    return starts.count(0), starts.count(memory.ID_SIZE)
+
+def test_chip_info():
+    memory = CorruptedMemory(0)
+    mem_map = read_chip_info(memory)
+    assert reads(memory) == (1, 1)
+    assert sum(size for addr, size in memory.reads) == memory.object_address(37)
+    assert mem_map.locate(memory.object_address(100) + 1) == (100, 0, 1)
+
+def test_crc_mismatch_reads_object_table_again():
+    memory = CorruptedMemory(1)
+    mem_map = read_chip_info(memory)
+    assert reads(memory) == (1, 2)  # ID information is not read again
+    assert mem_map.has_page((100, 0))
+
+def test_crc_mismatch_retry_limit():
+    memory = CorruptedMemory(100)
+    mem_map = read_chip_info(memory)
+    assert reads(memory) == (1, 1 + LogicDevice.INFO_READ_RETRY)
+    assert not mem_map.has_page((100, 0))
+    assert not mem_map.page_valid(Page.OBJECT_TABLE)
+
+def test_info_block_dump_keeps_map():
+    memory = CorruptedMemory(0)
+    logic = connect(memory)
+    end = memory.object_address(37)
+    logic.save_page_data(0, bytes(memory.mem[:end + 50]))  # raw dump over the info block
+    assert not logic.cmd_pending
+    assert logic.mem_map.locate(memory.object_address(100)) == (100, 0, 0)
+
+    data = bytearray(memory.mem[:end])
+    data[memory.ID_SIZE + 10] ^= 0x01   # object table changed, crc mismatch
+    logic.save_page_data(0, data)
+    assert len(logic.cmd_pending) == 1  # object table read again
+    assert not logic.mem_map.page_valid(Page.OBJECT_TABLE)
+
+def test_reconnect_reads_crc_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(MemMapStructure, 'CACHE_DIR', str(tmp_path))
+    read_chip_info(CorruptedMemory(0))
+    assert os.listdir(str(tmp_path)) == ['a61510aa20140c.tbl']
+
+    MemMapStructure._layout_cache.clear()   # another process
+    memory = CorruptedMemory(0)
+    mem_map = read_chip_info(memory)
+    crc_addr = memory.object_address(37) - memory.CRC_SIZE
+    assert memory.reads == [(0, 7), (crc_addr, memory.CRC_SIZE)]
+    assert mem_map.locate(memory.object_address(100)) == (100, 0, 0)
+
+def stale_cache(tmp_path, monkeypatch, count):
+    "memory of another object table, with the same ID information as the cached one"
+    monkeypatch.setattr(MemMapStructure, 'CACHE_DIR', str(tmp_path))
+    read_chip_info(CorruptedMemory(0))
+    MemMapStructure._layout_cache.clear()
+    memory = CorruptedMemory(count)
+    table_end = memory.object_address(37) - memory.CRC_SIZE
+    memory.mem[memory.ID_SIZE + 10] ^= 0x01
+    memory.mem[table_end: table_end + memory.CRC_SIZE] = crc24(memory.mem[:table_end]).to_bytes(3, 'little')
+    return memory, table_end
+
+def test_stale_cache_reads_object_table(tmp_path, monkeypatch):
+    memory, table_end = stale_cache(tmp_path, monkeypatch, 0)
+    mem_map = read_chip_info(memory)
+    assert reads(memory) == (1, 1)  # crc read, then the whole table
+    assert mem_map.has_page((100, 0))
+    with open(os.path.join(str(tmp_path), 'a61510aa20140c.tbl'), 'rb') as f:
+        assert f.read() == bytes(memory.mem[memory.ID_SIZE: table_end])
+
+def test_stale_cache_keeps_retry(tmp_path, monkeypatch):
+    memory, table_end = stale_cache(tmp_path, monkeypatch, LogicDevice.INFO_READ_RETRY)
+    mem_map = read_chip_info(memory)
+    assert reads(memory) == (1, 1 + LogicDevice.INFO_READ_RETRY)
+    assert mem_map.has_page((100, 0))
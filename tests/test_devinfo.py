@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from server.devinfo import crc24
+
+def reference_crc24(data, crc=0):
+    "one 16 bits word each step, as the maXTouch driver (mxt_calc_crc24)"
+    data = bytes(data)
+    if len(data) % 2:
+        data += b'\0'
+    for i in range(0, len(data), 2):
+        crc = (crc << 1) ^ (data[i] | data[i + 1] << 8)
+        if crc & 0x1000000:
+            crc ^= 0x80001B
+    return crc & 0xFFFFFF
+
+@pytest.mark.parametrize('data, crc, expected', [
+    (b'', 0, 0),
+    (b'\x01', 0, 0x000001),     # odd byte padded with 0
+    (b'\x34\x12', 0, 0x001234), # little endian word
+    (b'\x01\x00\x02\x00', 0, 0),
+    (b'\x00\x00', 0x800000, 0x80001B),  # reduced by the polynomial
+    (b'\xff\xff\xff\xff', 0xFFFFFF, 0xFEFFCB),
+])
+def test_crc24_vectors(data, crc, expected):
+    assert crc24(data, crc) == expected
+
+def test_crc24_reference():
+    rand = random.Random(24)
+    for size in range(0, 80):
+        data = bytes(rand.getrandbits(8) for _ in range(size))
+        expected = reference_crc24(data)
+        assert crc24(data) == expected, size
+        assert crc24(bytearray(data)) == expected
+        assert crc24(memoryview(data)) == expected
+
+    data = bytes(rand.getrandbits(8) for _ in range(7 + 37 * 6))    # size of an info block
+    assert crc24(memoryview(bytearray(16) + data)[16:]) == reference_crc24(data)
+    assert crc24(data[32:], crc24(data[:32])) == reference_crc24(data)
@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+from bus.hid_bus import Hid_Device, PhyMessage
+from bus.simulated import SimulatedTransport
+from server.message import DeadlineTimer, Message, ServerMessage, ThreadServer, Token
+
+@pytest.fixture
+def timer():
+    "bus timer shared by the devices"
+    timer = DeadlineTimer()
+    yield timer
+    timer.close()
+
+def test_report_lock_per_device(timer):
+    a, b = Hid_Device(SimulatedTransport('a'), timer=timer), Hid_Device(SimulatedTransport('b'), timer=timer)
+    assert a.report_lock is not b.report_lock
+    msg = PhyMessage.alloc(PhyMessage.MSG_HID_RAW_DATA, a.id(), Message.seq_root(), lock=a.report_lock)
+    assert msg.lock is a.report_lock
+    msg.release()
+    assert msg.lock is None
+
+def test_block_over_address_space_naks():
+    dev = Hid_Device(SimulatedTransport('c'))
+    dev.start()
+    try:
+        logic_pipe, phy_pipe = dev.attach_info()
+        for addr, size in ((0xFFF0, 0x20), (0xFFC0, 0x40)):
+            ServerMessage.alloc(Message.CMD_DEVICE_PAGE_READ, dev.id(), Token([1, addr]), addr=addr, size=size,
+                                pipe=phy_pipe).send()
+        dev.process()
+        replies = []
+        deadline = time.time() + 2
+        while len(replies) < 2 and time.time() < deadline:
+            ThreadServer.process()
+            if logic_pipe.poll(0.01):
+                msg = logic_pipe.recv()
+                if msg.type() != Message.MSG_DEVICE_BUSY:
+                    replies.append((msg.type(), msg.seq()))
+        assert replies[0] == (Message.MSG_DEVICE_NAK, [1, 0xFFF0])
+        assert replies[1][0] == Message.CMD_DEVICE_PAGE_READ and replies[1][1] == [1, 0xFFC0]
+    finally:
+        dev.stop()
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+core = pytest.importorskip("bus.pywinusb.hid.core")    # windows only
+InputReportQueue = core.HidDevice.InputReportQueue
+
+def fill(queue, count):
+    for i in range(count):
+        report = queue.get_new()
+        report[0] = i
+        queue.post(report)
+
+@pytest.mark.parametrize("overflow", (InputReportQueue.DROP_OLDEST, InputReportQueue.DROP_NEWEST))
+def test_drop_policy(overflow):
+    queue = InputReportQueue(2, 4, overflow)
+    fill(queue, 5)  # max_size + 1 buffers could be posted
+    values = [queue.get()[0] for _ in range(3)]
+    assert values == ([2, 3, 4] if overflow == InputReportQueue.DROP_OLDEST else [0, 1, 2])
+    assert queue.dropped == 2
+
+def test_get_all_leaves_a_buffer():
+    queue = InputReportQueue(4, 4)
+    fill(queue, 5)
+    batch = queue.get_all()
+    assert len(batch) == 3
+    assert queue.get_new() is not None
+
+@pytest.mark.parametrize("overflow", (InputReportQueue.DROP_OLDEST, InputReportQueue.DROP_NEWEST,
+                                      InputReportQueue.BLOCK))
+def test_consumer_holds_all_buffers(overflow):
+    "the reading thread waits for a buffer reused instead of spinning"
+    queue = InputReportQueue(2, 4, overflow)
+    fill(queue, 3)
+    held = [queue.get() for _ in range(3)]
+    result = {}
+
+    def producer():
+        cpu = time.thread_time()
+        result['report'] = queue.get_new()
+        result['cpu'] = time.thread_time() - cpu
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+    queue.reuse(held[0])
+    thread.join(1)
+    assert result['report'] is held[0]
+    assert result['cpu'] < 0.05
+    queue.release_events()
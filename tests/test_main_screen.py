@@ -0,0 +1,26 @@
+from server.message import MessageServer
+from ui.MainUi import MainScreen
+
+def attach(screen, id):
+    pipes = (MessageServer.mPipe(id + ':logic'), MessageServer.mPipe(id + ':phy'))
+    screen.handle_bus_detected(id, pipes)
+    return pipes
+
+def test_closed_device_pipe_removes_device():
+    screen = MainScreen()
+    logic_pipe, phy_pipe = attach(screen, 'dev0')
+    attach(screen, 'dev1')
+    logic_pipe.close()
+    screen.process()
+    assert list(screen.devices) == ['dev1']
+    screen.process()
+
+def test_closed_bus_pipe():
+    screen = MainScreen()
+    screen.pipe_from_bus = MessageServer.mPipe('closed_bus')
+    attach(screen, 'dev0')
+    screen.pipe_from_bus.close()
+    screen.process()
+    assert screen.pipe_from_bus is None
+    assert list(screen.devices) == ['dev0']
+    screen.process()
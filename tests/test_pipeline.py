@@ -0,0 +1,11 @@
+import argparse
+
+from benchmarks import pipeline
+
+def test_scenarios_complete():
+    args = argparse.Namespace(n=50, warmup=5, devices=2, window=2, rate=0, latency=0, jitter=0, loss=0,
+                              scenario=None, output=None)
+    report = pipeline.run(args)
+    assert [r['name'] for r in report['scenarios']] == ['read', 'dump', 'irq', 'devices']
+    for r in report['scenarios']:
+        assert r['commands'] and not r['errors'], r
@@ -0,0 +1,77 @@
+import time
+
+from bus.manage import PhyDevice
+from bus.simulated import SimulatedTransport
+from server.message import DeadlineTimer, MessageServer, ThreadServer
+import test_kits
+from ui.MainUi import MainScreen
+
+def run(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        ThreadServer.process()
+        ThreadServer.wait(max(end - time.time(), 0))
+
+def test_pipe_driven_entry():
+    calls = []
+    pipe = MessageServer.mPipe('test:scheduler')
+    process = lambda: calls.append(pipe.recv() if pipe.poll() else None)
+    ThreadServer.register('test:scheduler', process, interval=None, pipes=(pipe, ))
+    try:
+        run(0.05)
+        count = len(calls)  # run once after registered
+        run(0.1)
+        assert len(calls) == count
+        pipe.send('msg')
+        run(0.05)
+        assert calls[-1] == 'msg' and len(calls) == count + 1
+    finally:
+        ThreadServer.unregister('test:scheduler', process)
+
+def test_deadline_timer():
+    timer = DeadlineTimer()
+    fired = []
+    timer.add(0.05, fired.append, 1)
+    timer.cancel(timer.add(0.01, fired.append, 2))
+    assert timer.next_delay() <= 0.05
+    run(0.1)
+    assert fired == [1]
+    assert timer.next_delay() is None
+    timer.add(0, fired.append, 3)
+    timer.close()
+    run(0.05)
+    assert fired == [1]
+
+def timers():
+    return len(ThreadServer._find(DeadlineTimer.__name__))
+
+def test_device_timer_closed():
+    count = timers()
+    dev = PhyDevice(SimulatedTransport('own'))
+    assert timers() == count + 1
+    dev.stop()
+    assert timers() == count
+
+    timer = DeadlineTimer()
+    dev = PhyDevice(SimulatedTransport('bus'), timer=timer)
+    dev.stop()
+    assert timers() == count + 1    # bus timer is kept
+    timer.close()
+    assert timers() == count
+
+def test_kits_delay():
+    kits = test_kits.TestKits(api={})
+    assert kits.next_delay() == 0
+    kits.ticks = time.time()
+    assert 0.9 < kits.next_delay() <= kits.TEST_FRAME_INIT_TIME
+
+def test_idle_screen_has_no_timer():
+    screen = MainScreen()
+    screen.pipe_from_bus = MessageServer.mPipe('idle_bus')
+    screen.process()
+    assert screen.deadline is None
+    screen.handle_bus_detected('dev0', (MessageServer.mPipe('dev0:logic'), MessageServer.mPipe('dev0:phy')))
+    screen.process()    # bridge poll command sent, wait for the reply or the command timeout
+    dev = screen.devices['dev0']
+    assert dev.cmd_list and not dev.cmd_pending
+    assert 9 < screen.deadline[DeadlineTimer.DUE] - time.time() <= dev.CMD_TIMEOUT
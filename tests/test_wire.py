@@ -0,0 +1,52 @@
+import struct
+
+import pytest
+
+from server import wire
+from server.message import BaseMessage, MsgError, Token
+from server.shmring import ShmChannel
+
+def message(type=3, **kwargs):
+    return BaseMessage('Device', type, 'dev0', Token([1, -2, 300]), **kwargs)
+
+def test_round_trip():
+    msg = message(value=bytearray(range(10)), addr=0x1234, size=10.5, name='T100', items=(1, None, True))
+    data = wire.encode(msg)
+    result = wire.decode(data)
+    assert (result.loc(), result.type(), result.id(), result.seq()) == ('Device', 3, 'dev0', [1, -2, 300])
+    info = result.extra_info()
+    assert bytes(info['value']) == bytes(range(10))
+    assert (info['addr'], info['size'], info['name'], info['items']) == (0x1234, 10.5, 'T100', (1, None, True))
+
+@pytest.mark.parametrize("size", range(0, 40, 3))
+def test_short_buffer(size):
+    with pytest.raises(IndexError):
+        wire.encode_into(message(value=bytes(32), size=1.0), bytearray(size))
+
+@pytest.mark.parametrize("type", (0x10000, -1))
+def test_type_out_of_range(type):
+    "not reported as short buffer, so the encoding buffer is not grown for it"
+    with pytest.raises(struct.error):
+        wire.encode(message(type))
+
+def test_non_contiguous_payload():
+    view = memoryview(bytes(range(32)))[::2]
+    assert bytes(wire.decode(wire.encode(message(value=view))).value()) == bytes(view)
+
+def test_encode_limit(monkeypatch):
+    monkeypatch.setattr(wire, 'MAX_SIZE', 1024)
+    assert len(wire.encode(message(value=bytes(900)))) > 900
+    with pytest.raises(MsgError):
+        wire.encode(message(value=bytes(2000)))
+
+def test_channel_rejects_bad_message():
+    channel = ShmChannel(capacity=4096)
+    try:
+        assert not channel.send(message(0x10000))
+        assert not channel.send(message(value=bytes(8192)))   # larger than the ring
+        assert len(channel.scratch) < 4096
+        assert channel.send(message(value=bytes(1000)))
+        received = list(channel.recv_all())
+        assert len(received) == 1 and bytes(received[0].value()) == bytes(1000)
+    finally:
+        channel.ring.release()
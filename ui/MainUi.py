@@ -1,9 +1,12 @@
 import os
+from collections import OrderedDict, deque
 from random import random
 from multiprocessing import Process
+import time
 from time import gmtime, strftime
 
-from server.message import Message, MessageServer, UiMessage, ServerMessage, ThreadServer
+from server.devinfo import MemMapStructure, Page
+from server.message import Message, MessageServer, UiMessage, ServerMessage, ThreadServer, DeadlineTimer
 
 from test_kits import TestKits
 
@@ -13,6 +16,8 @@ class UiError(Exception):
 
 class LogicDevice(object):
     CMD_STACK_DEPTH = 1000
+    CMD_TIMEOUT = 10 #second, phy device naks its own timeout, this is for the reply lost
+    INFO_READ_RETRY = 3 #object table is read again if the info crc mismatch
 
     [STS_DETACH, STS_ATTACHED, STS_CONNECTED] = range(3)
 
@@ -20,9 +25,13 @@ class LogicDevice(object):
         self.__id = id
         self.logic_pipe, self.phy_pipe = logic_phy_pipes
         self.cmd_seq = 0
-        self.cmd_list = []
+        self.cmd_list = OrderedDict()   #commands wait for reply, indexed by seq key in sending order
+        self.cmd_pending = deque()  #commands not sent yet
         self.msg_list = []
         self.status = self.STS_DETACH
+        self.busy = False   #phy device command queue is full, hold the commands
+        self.mem_map = None #memory map of the chip, created when chip info read
+        self.info_retry = 0
         api_test_kits = {"api": {"set_raw_command": self.set_raw_command, "set_get_chip_info":self.set_get_chip_info}}
         self.kits = TestKits(**api_test_kits)
 
@@ -48,31 +57,110 @@ class LogicDevice(object):
 
         #self.cmd_list.append(Message(type, self.id(), self.next_seq(seq), **kwargs, pipe=self.pipe()))
         command.set_pipe(self.phy_pipe)
-        self.cmd_list.append(command)
+        self.cmd_list[command.seq_key()] = command
+        self.cmd_pending.append(command)
 
     def send_command(self):
-        for cmd in self.cmd_list:
+        while self.cmd_pending and not self.busy:
+            cmd = self.cmd_pending.popleft()
             cmd.send()
 
+    def expire_command(self):
+        "commands are sent in order, so check from the oldest one until the first not timeout"
+        while self.cmd_list:
+            key, cmd = next(iter(self.cmd_list.items()))
+            if not cmd.is_status(Message.SEND) or not cmd.timeout(self.CMD_TIMEOUT):
+                break
+
+            del self.cmd_list[key]
+            seq = cmd.seq()
+            seq.pop()
+            self.handle_nak_msg(seq, error="timeout")
+            cmd.release()
+
     def set_bridge_poll(self, kwargs={}):
-        command = ServerMessage(Message.CMD_POLL_BRIDGE, self.id(), self.next_seq(Message.seq_root()), **kwargs)
+        command = ServerMessage.alloc(Message.CMD_POLL_BRIDGE, self.id(), self.next_seq(Message.seq_root()), **kwargs)
         self.prepare_command(command)
 
     def set_get_chip_info(self):
-        kwargs = {'addr': 0, 'size':7}
-        command = ServerMessage(Message.CMD_DEVICE_PAGE_READ, self.id(), self.next_seq(Message.seq_root()), **kwargs)
+        "read ID information, then the object table, the pages of memory map are created after info crc checked"
+        if self.mem_map:    # chip may be changed after reset
+            self.mem_map.close()
+        self.mem_map = MemMapStructure()
+        self.info_retry = 0
+        self.read_page(self.mem_map.get_page(Page.ID_INFORMATION))
+
+    def read_page(self, page, start=0):
+        "read the page data from start to the page end"
+        kwargs = {'addr': page.addr() + start, 'size': page.size() - start}
+        command = ServerMessage.alloc(Message.CMD_DEVICE_PAGE_READ, self.id(), self.next_seq(Message.seq_root()), **kwargs)
         self.prepare_command(command)
 
+    def save_page_data(self, addr, value):
+        """save the read data to the memory map, then parse the info pages which are complete,
+           parsing creates the object table and the object pages again, so it is done after all saved"""
+        mem_map = self.mem_map
+        if not mem_map or not len(value):
+            return
+
+        completed = []
+        for page in mem_map.pages_in_range(addr, len(value)):
+            start = max(page.addr(), addr)
+            end = min(page.addr() + page.size(), addr + len(value))
+            data = value[start - addr: end - addr]
+            if page.id() == Page.ID_INFORMATION and page.get_info() and \
+                    page.buf()[start - page.addr(): end - page.addr()] == data:
+                continue    # parsed already, the memory map is kept
+            page.save_to_buffer(start - page.addr(), data)
+            if page.id() in (Page.ID_INFORMATION, Page.OBJECT_TABLE) and page.buffer_data_valid():
+                completed.append(page.id())
+
+        if Page.ID_INFORMATION in completed:
+            table = mem_map.page_parse(Page.ID_INFORMATION)
+            if not table:
+                return
+            if not table.buffer_data_valid():   # the table of known firmware is filled from cache, only the info crc is read
+                self.read_page(table, table.data_length())
+                return
+            completed.append(Page.OBJECT_TABLE)
+
+        if Page.OBJECT_TABLE in completed:
+            cached = mem_map.table_cached()
+            if mem_map.page_parse(Page.OBJECT_TABLE) is False:    # info crc mismatch, object table cleared
+                if cached or self.info_retry < self.INFO_READ_RETRY:
+                    if not cached:  # stale cache is not a read failure
+                        self.info_retry += 1
+                    page = mem_map.get_page(Page.OBJECT_TABLE)
+                    self.read_page(page, page.data_length())
+                else:
+                    print("Logic device {} info crc mismatch, retried {}".format(self.id(), self.info_retry))
+
     def set_raw_command(self, raw_data):
         kwargs = {'value': raw_data}
-        command = ServerMessage(Message.CMD_DEVICE_RAW_DATA, self.id(), self.next_seq(Message.seq_root()), **kwargs)
+        command = ServerMessage.alloc(Message.CMD_DEVICE_RAW_DATA, self.id(), self.next_seq(Message.seq_root()), **kwargs)
         self.prepare_command(command)
 
     def poll(self):
+        self.expire_command()
         if self.status == self.STS_CONNECTED:
             if self.ready():
                 self.kits.poll()
 
+    def poll_delay(self):
+        "seconds to the next poll() due, None if waiting for the messages only"
+        delays = []
+        if self.cmd_pending and not self.busy:
+            delays.append(0)
+        if self.cmd_list:
+            cmd = next(iter(self.cmd_list.values()))
+            if cmd.is_status(Message.SEND):
+                delays.append(max(cmd.time_left(self.CMD_TIMEOUT), 0))
+        if self.status == self.STS_CONNECTED and self.ready():
+            delays.append(self.kits.next_delay())
+
+        if delays:
+            return min(delays)
+
     def handel_bus_detected_msg(self, seq, data):
         kwargs = {'repeat': self.INTERVAL_POLL_DEVICE}
         self.set_bridge_poll(kwargs)
@@ -92,6 +180,7 @@ class LogicDevice(object):
     def handle_page_read_msg(self, seq, cmd, data):
         t = strftime("%b-%d %H:%M:%S", gmtime())
         print(t, "R:", seq, data)
+        self.save_page_data(cmd.extra_info()['addr'], data['value'])
         if (all(data)):
             self.status = self.STS_CONNECTED
 
@@ -102,6 +191,10 @@ class LogicDevice(object):
         #print("Raw:", seq, data)
         pass
 
+    def handle_interrupt_data_msg(self, seq, data):
+        #print("IRQ:", seq, data)
+        pass
+
     def handle_nak_msg(self, seq, error):
         print("Nak:", seq, error)
 
@@ -113,73 +206,102 @@ class LogicDevice(object):
             self.handel_bus_detected_msg(seq, msg.extra_info())
         elif type == Message.MSG_DEVICE_INTERRUPT_DATA:
             self.handle_interrupt_data_msg(seq, msg.extra_info())
+        elif type == Message.MSG_DEVICE_BUSY:
+            self.busy = msg.extra_info()['value']
         else:
-            for i, cmd in enumerate(self.cmd_list[:]):
-                #print("handle_message: seq msg={} cmd={}".format(seq, cmd.seq()))
-                if cmd.seq() == seq:
-                    seq.pop()
-
-                    if type == Message.MSG_BRIDGE_ATTACH:
-                        self.handle_attached_msg(seq,msg.extra_info())  # only status of attached, since detach will Logici device is removed
-                    # elif type == Message.MSG_DEVICE_CONNECTED:
-                    #     self.handle_connected_msg(seq, msg.extra_info())
-                    elif type == Message.CMD_DEVICE_PAGE_READ:
-                        self.handle_page_read_msg(seq, cmd, msg.extra_info())
-                    # elif type == Message.MSG_DEVICE_BLOCK_READ:
-                    #     self.handle_block_read_msg(seq, cmd, msg.extra_info())
-                    elif type == Message.CMD_DEVICE_PAGE_WRITE:
-                        self.handle_page_write_msg(seq, cmd, msg.extra_info())
-                    elif type == Message.CMD_DEVICE_RAW_DATA:
-                        self.handle_raw_data_msg(seq, cmd, msg.extra_info())
-                    elif type == Message.CMD_DEVICE_MSG_OUTPUT:
-                        self.handle_raw_data_msg(seq, cmd, msg.extra_info())
-                    elif type == Message.MSG_DEVICE_NAK:
-                        self.handle_nak_msg(seq, error=msg)
-                    else:
-                        raise ServerError("Logic device id '{}' msg {} seq not match".format(id, msg))
-                        self.handle_nak_msg(seq, error="Unknow msg type {}".format(type))
-
-                    del self.cmd_list[i]
-                    break
+            cmd = self.cmd_list.pop(msg.seq_key(), None)
+            #print("handle_message: seq msg={} cmd={}".format(seq, cmd))
+            if cmd:
+                seq.pop()
+
+                if type == Message.MSG_BRIDGE_ATTACH:
+                    self.handle_attached_msg(seq,msg.extra_info())  # only status of attached, since detach will Logici device is removed
+                # elif type == Message.MSG_DEVICE_CONNECTED:
+                #     self.handle_connected_msg(seq, msg.extra_info())
+                elif type == Message.CMD_DEVICE_PAGE_READ:
+                    self.handle_page_read_msg(seq, cmd, msg.extra_info())
+                # elif type == Message.MSG_DEVICE_BLOCK_READ:
+                #     self.handle_block_read_msg(seq, cmd, msg.extra_info())
+                elif type == Message.CMD_DEVICE_PAGE_WRITE:
+                    self.handle_page_write_msg(seq, cmd, msg.extra_info())
+                elif type == Message.CMD_DEVICE_RAW_DATA:
+                    self.handle_raw_data_msg(seq, cmd, msg.extra_info())
+                elif type == Message.CMD_DEVICE_MSG_OUTPUT:
+                    self.handle_raw_data_msg(seq, cmd, msg.extra_info())
+                elif type == Message.MSG_DEVICE_NAK:
+                    self.handle_nak_msg(seq, error=msg)
+                else:
+                    raise ServerError("Logic device id '{}' msg {} seq not match".format(id, msg))
+                    self.handle_nak_msg(seq, error="Unknow msg type {}".format(type))
+
+                cmd.release()
 
 class MainScreen(object):
-    "Main Screen"
+    "Main Screen, process() runs when message arrived or the device poll is due, no polling while idle"
 
     def __init__(self, **kwargs):
         #self.pipe_to_server = MessageServer.get('ui_to_server')
         #self.pipe_from_server = MessageServer.get('server_to_ui')
         self.pipe_from_bus = MessageServer.open('bus_to_server')
         self.devices = dict()
+        self.timer = DeadlineTimer()    # command timeout and test kits timing of the devices
+        self.deadline = None
         super(MainScreen, self).__init__(**kwargs)
 
     def handle_bus_detected_msg(self, id, msg):
         ext_info = msg.extra_info()
-        val = ext_info['value']
+        self.handle_bus_detected(id, ext_info['value'])
+
+    def handle_bus_changed_msg(self, msg):
+        for key, id, val in msg.value():
+            self.handle_bus_detected(id, val, key)
+
+    def handle_bus_detected(self, id, val, key=None):
+        "devices are indexed by the bus device key, which is kept after re-plugged to the same port"
+        if key is None:
+            key = id
 
         #remove device
-        if id in self.devices.keys():
+        if key in self.devices.keys():
             if not val:
-                del self.devices[id]
+                self.remove_device(key)
         else:
             if val:
                 dev = LogicDevice(id, val)
-                self.devices[id] = dev
+                self.devices[key] = dev
+                ThreadServer.watch(self.__class__.__name__, self.process, dev.logic_pipe)
                 dev.set_bridge_poll()
 
+    def remove_device(self, key):
+        dev = self.devices.pop(key)
+        ThreadServer.unwatch(self.__class__.__name__, self.process, dev.logic_pipe)
+
     def dispatch(self):
-        for dev in self.devices.values():
-            has_msg = dev.logic_pipe.poll(0)
-            if has_msg:
-                msg = dev.logic_pipe.recv()
+        for key, dev in list(self.devices.items()):
+            while dev.logic_pipe.poll(0):
+                try:
+                    msg = dev.logic_pipe.recv()
+                except EOFError:    # closed pipe keeps polled ready, stop watching it
+                    print("Process EOF: {} device {}".format(self.__class__.__name__, dev.id()))
+                    self.remove_device(key)
+                    break
+
                 type = msg.type()
                 id = msg.id()
 
                 dev.handle_message(msg)
+                msg.release()
 
     def recv(self):
-        has_msg = self.pipe_from_bus.poll(0)
-        if has_msg:
-            msg = self.pipe_from_bus.recv()
+        while self.pipe_from_bus and self.pipe_from_bus.poll(0):
+            try:
+                msg = self.pipe_from_bus.recv()
+            except EOFError:
+                print("Process EOF: {} bus".format(self.__class__.__name__))
+                ThreadServer.unwatch(self.__class__.__name__, self.process, self.pipe_from_bus)
+                self.pipe_from_bus = None
+                break
+
             type = msg.type()
             id = msg.id()
             #print("Process<{}> recv message: {}".format(self.__class__.__name__, msg))
@@ -187,6 +309,9 @@ class MainScreen(object):
 
             if type == Message.MSG_BUS_FOUND:
                 self.handle_bus_detected_msg(id, msg)
+            elif type == Message.MSG_BUS_CHANGED:
+                self.handle_bus_changed_msg(msg)
+            msg.release()
 
 
         self.dispatch()
@@ -199,13 +324,35 @@ class MainScreen(object):
         for dev in self.devices.values():
             dev.poll()
 
+    def wakeup(self):
+        self.deadline = None
+        ThreadServer.wakeup(self.__class__.__name__, self.process)
+
+    def set_timer(self):
+        "wake up at the nearest device poll due, the earlier deadline is kept (process() sets it again)"
+        delays = [d for d in (dev.poll_delay() for dev in self.devices.values()) if d is not None]
+        if not delays:
+            return
+
+        due = time.time() + min(delays)
+        if self.deadline and self.deadline[DeadlineTimer.DUE] <= due:
+            return
+
+        self.timer.cancel(self.deadline)
+        self.deadline = self.timer.add(min(delays), self.wakeup)
+
+    def process(self):
+        self.recv()
+        self.poll()
+        self.send()     # the commands of poll() too
+        self.set_timer()
+
     def update(self):
+        ThreadServer.register(self.__class__.__name__, self.process,
+                              interval=None, pipes=(self.pipe_from_bus, ))
         while True:
             ThreadServer.process()
-
-            self.recv()
-            self.send()
-            self.poll()
+            ThreadServer.wait()
 
 class MainUi(object):
     "Main Ui"